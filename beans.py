@@ -64,6 +64,8 @@ class ChromFeature:
   stop: str = None
   strand: str = None
   name: str = None
+  #bp to the feature this one was matched to, for nearest (non-overlapping) matches only
+  distance: int = None
 
 
 '''
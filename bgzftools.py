@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# Block compressed, indexed BED files for reading single regions without scanning the whole file.
+#
+# Files are written in the formats of bgzip and tabix -p bed, so either set of tools can read what the
+#  other wrote:
+#  - BGZF: a series of gzip members of at most 64KB uncompressed each. Still a valid .gz file.
+#  - .tbi: per chromosome, the UCSC bins and 16kb windows features fall in, mapped to virtual file
+#    offsets (compressed offset of a block << 16 | offset within the uncompressed block).
+#
+# Written files must be sorted by chromosome and then start position, e.g. by sorttools.
+#
+
+import bisect
+import datetime
+import gzip
+import itertools
+import operator
+import os
+import struct
+import sys
+import zlib
+
+#local
+import downloader
+
+
+#uncompressed bytes per block, as bgzip
+BLOCK_SIZE = 0xff00
+#empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+#linear index window size is 1 << LINEAR_SHIFT bp
+LINEAR_SHIFT = 14
+#(bin size shift, first bin number) for each level of the UCSC binning scheme, smallest bins first
+BIN_LEVELS = ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1))
+#largest coordinate the binning scheme covers, used for whole chromosome regions
+MAX_COORDINATE = 1 << 29
+#tabix -p bed preset: UCSC 0-based coordinates, chrom/start/end in columns 1/2/3, '#' meta lines
+TBI_FORMAT = 0x10000
+TBI_COLUMNS = (1, 2, 3)
+TBI_META = '#'
+HEADER_PREFIXES = (b'#', b'track', b'browser')
+
+
+#compresses up to BLOCK_SIZE bytes into a single BGZF block
+def compressBlock(data):
+  deflater = zlib.compressobj(6, zlib.DEFLATED, -15)
+  compressed = deflater.compress(data) + deflater.flush()
+  #gzip header with the 'BC' extra subfield holding the total block size - 1
+  header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25)
+  return header + compressed + struct.pack('<2I', zlib.crc32(data), len(data))
+
+#returns the bin a feature [start, end) is stored under: the smallest bin containing it
+def getBin(start, end):
+  end = max(end, start + 1) - 1
+  for (shift, first) in BIN_LEVELS:
+    if start >> shift == end >> shift:
+      return first + (start >> shift)
+  return 0
+
+#returns all the bins that may hold features overlapping [start, end)
+def getRegionBins(start, end):
+  end = max(end, start + 1) - 1
+  bins = [0]
+  for (shift, first) in reversed(BIN_LEVELS):
+    bins.extend(range(first + (start >> shift), first + (end >> shift) + 1))
+  return bins
+
+#whether a path is a BGZF file with a tabix index next to it
+def isIndexed(path):
+  return path.endswith('.gz') and os.path.isfile(path + '.tbi')
+
+#parses a samtools/tabix style region, e.g. chr7:1,000,000-2,000,000 (1-based, inclusive) or chr7,
+# into a 0-based half-open (chrom, start, end)
+def parseRegion(region):
+  chrom, _, span = region.partition(':')
+  if not span:
+    return (chrom, 0, MAX_COORDINATE)
+  start, _, end = span.replace(',', '').partition('-')
+  return (chrom, int(start) - 1, int(end) if end else MAX_COORDINATE)
+
+
+class BgzfWriter(object):
+  '''
+  Writes a BGZF file, keeping track of the virtual offset of the current position.
+  '''
+  def __init__(self, path):
+    self.file = open(path, 'wb')
+    self.address = 0
+    self.buffer = bytearray()
+
+  def tell(self):
+    return (self.address << 16) | len(self.buffer)
+
+  def write(self, data):
+    self.buffer += data
+    while len(self.buffer) >= BLOCK_SIZE:
+      self.flushBlock(BLOCK_SIZE)
+
+  def flushBlock(self, size):
+    block = compressBlock(bytes(self.buffer[:size]))
+    self.file.write(block)
+    self.address += len(block)
+    del self.buffer[:size]
+
+  def close(self):
+    if self.buffer:
+      self.flushBlock(len(self.buffer))
+    self.file.write(EOF_BLOCK)
+    self.file.close()
+
+
+class BgzfReader(object):
+  '''
+  Reads lines of a BGZF file from virtual offsets, decompressing only the blocks read.
+  '''
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    self.address = None
+    self.nextAddress = 0
+    self.block = b''
+    self.offset = 0
+
+  def loadBlock(self, address):
+    self.file.seek(address)
+    header = self.file.read(12)
+    if len(header) < 12:
+      return False
+    extra = self.file.read(struct.unpack('<H', header[10:12])[0])
+    blockSize = None
+    i = 0
+    while i + 4 <= len(extra):
+      (subfield, length) = struct.unpack('<2sH', extra[i:i + 4])
+      if subfield == b'BC':
+        blockSize = struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+      i += 4 + length
+    if blockSize is None:
+      raise ValueError(f'{self.file.name} is not a BGZF file (block at {address} has no size)')
+    data = self.file.read(blockSize - 12 - len(extra))
+    self.block = zlib.decompress(data[:-8], -15)
+    self.address = address
+    self.nextAddress = address + blockSize
+    self.offset = 0
+    return True
+
+  def seek(self, virtualOffset):
+    address = virtualOffset >> 16
+    if address != self.address:
+      self.loadBlock(address)
+    self.offset = virtualOffset & 0xffff
+
+  def tell(self):
+    #the end of a block is the start of the next one
+    if self.block and self.offset >= len(self.block):
+      return self.nextAddress << 16
+    return ((self.address or 0) << 16) | self.offset
+
+  def readline(self):
+    parts = []
+    while True:
+      if self.offset >= len(self.block):
+        if not self.loadBlock(self.nextAddress):
+          break
+        continue
+      end = self.block.find(b'\n', self.offset)
+      if end < 0:
+        parts.append(self.block[self.offset:])
+        self.offset = len(self.block)
+        continue
+      parts.append(self.block[self.offset:end + 1])
+      self.offset = end + 1
+      break
+    return b''.join(parts)
+
+  def close(self):
+    self.file.close()
+
+
+#writes sorted BED lines to a BGZF file and its .tbi index. track and browser lines are dropped as
+# tabix only skips '#' meta lines.
+def writeIndexedBed(lines, output):
+  downloader.createPathToFile(output)
+  writer = BgzfWriter(output)
+  #chrom -> (bin -> list of [start, end] virtual offset chunks, linear index)
+  refs = {}
+  chrom = None
+  lastStart = -1
+  try:
+    for line in lines:
+      if isinstance(line, str):
+        line = line.encode()
+      if not line.endswith(b'\n'):
+        line += b'\n'
+      if not line.strip() or line.startswith(HEADER_PREFIXES):
+        if line.startswith(TBI_META.encode()):
+          writer.write(line)
+        continue
+      cols = line.split(b'\t', 3)
+      (lineChrom, start, end) = (cols[0].decode(), int(cols[1]), int(cols[2]))
+      if lineChrom != chrom:
+        if lineChrom in refs:
+          raise ValueError(f'Cannot index {output}: input not sorted, {lineChrom} is not contiguous')
+        refs[lineChrom] = ({}, [])
+        chrom = lineChrom
+        lastStart = -1
+      if start < lastStart:
+        raise ValueError(f'Cannot index {output}: input not sorted at {lineChrom}:{start}')
+      lastStart = start
+      begin = writer.tell()
+      writer.write(line)
+      (bins, linear) = refs[chrom]
+      chunks = bins.setdefault(getBin(start, end), [])
+      if chunks and chunks[-1][1] == begin:
+        chunks[-1][1] = writer.tell()
+      else:
+        chunks.append([begin, writer.tell()])
+      lastWindow = (max(end, start + 1) - 1) >> LINEAR_SHIFT
+      if len(linear) <= lastWindow:
+        linear.extend([None] * (lastWindow + 1 - len(linear)))
+      for window in range(start >> LINEAR_SHIFT, lastWindow + 1):
+        if linear[window] is None:
+          linear[window] = begin
+  finally:
+    writer.close()
+  writeIndex(output + '.tbi', refs)
+
+#writes the .tbi index of a BGZF file. windows no feature overlaps take the offset of the next window.
+def writeIndex(path, refs):
+  names = b''.join(name.encode() + b'\0' for name in refs)
+  data = bytearray(b'TBI\x01')
+  data += struct.pack('<8i', len(refs), TBI_FORMAT, *TBI_COLUMNS, ord(TBI_META), 0, len(names))
+  data += names
+  for (bins, linear) in refs.values():
+    data += struct.pack('<i', len(bins))
+    for (binNumber, chunks) in sorted(bins.items()):
+      data += struct.pack('<Ii', binNumber, len(chunks))
+      for (begin, end) in chunks:
+        data += struct.pack('<2Q', begin, end)
+    for window in range(len(linear) - 2, -1, -1):
+      if linear[window] is None:
+        linear[window] = linear[window + 1]
+    data += struct.pack(f'<i{len(linear)}Q', len(linear), *linear)
+  writer = BgzfWriter(path)
+  writer.write(data)
+  writer.close()
+
+#reads a .tbi index into chrom -> (bin -> list of (start, end) chunks, linear index)
+def readIndex(path):
+  with gzip.open(path, 'rb') as f:
+    data = f.read()
+  if data[:4] != b'TBI\x01':
+    raise ValueError(f'{path} is not a tabix index')
+  (nRefs, _, _, _, _, _, _, namesLength) = struct.unpack_from('<8i', data, 4)
+  pos = 36
+  names = data[pos:pos + namesLength].split(b'\0')[:nRefs]
+  pos += namesLength
+  index = {}
+  for name in names:
+    bins = {}
+    (nBins,) = struct.unpack_from('<i', data, pos)
+    pos += 4
+    for _ in range(nBins):
+      (binNumber, nChunks) = struct.unpack_from('<Ii', data, pos)
+      pos += 8
+      offsets = struct.unpack_from(f'<{2 * nChunks}Q', data, pos)
+      pos += 16 * nChunks
+      bins[binNumber] = list(zip(offsets[::2], offsets[1::2]))
+    (nWindows,) = struct.unpack_from('<i', data, pos)
+    pos += 4
+    linear = struct.unpack_from(f'<{nWindows}Q', data, pos)
+    pos += 8 * nWindows
+    index[name.decode()] = (bins, linear)
+  return index
+
+#returns the sorted, merged chunks of virtual offsets holding features that may overlap [start, end)
+def getRegionChunks(index, chrom, start, end):
+  if chrom not in index:
+    return []
+  (bins, linear) = index[chrom]
+  window = start >> LINEAR_SHIFT
+  if window >= len(linear):
+    return []
+  minOffset = linear[window]
+  chunks = sorted((max(begin, minOffset), chunkEnd) for binNumber in getRegionBins(start, end)
+      for (begin, chunkEnd) in bins.get(binNumber, ()) if chunkEnd > minOffset)
+  merged = []
+  for (begin, chunkEnd) in chunks:
+    if merged and begin <= merged[-1][1]:
+      merged[-1][1] = max(merged[-1][1], chunkEnd)
+    else:
+      merged.append([begin, chunkEnd])
+  return merged
+
+#yields the lines of an indexed BED file overlapping any of the (chrom, start, end) regions, reading
+# only the blocks that hold them. each chromosome's lines are yielded once, in file order, and the
+# chromosomes in the order they first appear in regions.
+def iterRegionLines(bedGz, regions, index=None):
+  if index is None:
+    index = readIndex(bedGz + '.tbi')
+  reader = BgzfReader(bedGz)
+  try:
+    for (chrom, chromRegions) in itertools.groupby(regions, key=operator.itemgetter(0)):
+      #merge the regions so a line overlapping any one of them overlaps the last starting before its end
+      merged = []
+      for (_, start, end) in sorted(chromRegions):
+        if merged and start <= merged[-1][1]:
+          merged[-1][1] = max(merged[-1][1], end)
+        else:
+          merged.append([start, end])
+      starts = [start for (start, end) in merged]
+      chunks = []
+      for (start, end) in merged:
+        chunks.extend(getRegionChunks(index, chrom, start, end))
+      chunks.sort()
+      position = 0
+      chromBytes = chrom.encode()
+      for (begin, chunkEnd) in chunks:
+        reader.seek(max(begin, position))
+        while reader.tell() < chunkEnd:
+          line = reader.readline()
+          if not line:
+            break
+          cols = line.split(b'\t', 3)
+          if cols[0] != chromBytes or line.startswith(HEADER_PREFIXES):
+            continue
+          (start, end) = (int(cols[1]), int(cols[2]))
+          i = bisect.bisect_left(starts, max(end, start + 1)) - 1
+          if i >= 0 and merged[i][1] > start:
+            yield line.decode()
+        position = max(position, reader.tell())
+  finally:
+    reader.close()
+
+#yields the lines of an indexed BED file overlapping a single 0-based half-open region
+def queryRegion(bedGz, chrom, start, end, index=None):
+  return iterRegionLines(bedGz, [(chrom, start, end)], index)
+
+#compresses and indexes a sorted BED file, e.g. data/probes.bed to data/probes.bed.gz(.tbi)
+def compressBedFile(bedFile, output):
+  print(f'bgzf - compressing and indexing {bedFile} to {output} @ {datetime.datetime.now()} ...')
+  with open(bedFile, 'r') as f:
+    writeIndexedBed(f, output)
+  print(f'bgzf - done @ {datetime.datetime.now()}')
+
+def __main__(argv):
+  if len(argv) == 4 and argv[1] == '--compress':
+    compressBedFile(argv[2], argv[3])
+  elif len(argv) > 2:
+    index = readIndex(argv[1] + '.tbi')
+    for region in argv[2:]:
+      sys.stdout.writelines(queryRegion(argv[1], *parseRegion(region), index))
+  else:
+    print(f'Usage: {argv[0]} <BED_GZ> <REGION> [<REGION> ...]')
+    print(f'       {argv[0]} --compress <SORTED_BED> <BED_GZ>')
+    print(f'Example: {argv[0]} data/probes.bed.gz chr7:1,000,000-2,000,000')
+    sys.exit(2)
+
+if __name__ == '__main__':
+  __main__(sys.argv)
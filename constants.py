@@ -21,7 +21,8 @@ FIND_GEO_DATASERIES_DEFAULTS = {
   'getAllPlatforms': False,
   'getPlatformsFromOverlap': 'data/probes.overlap.bed',
   'skipSeriesInfo': False,
-  'gdsOnly': True
+  'gdsOnly': True,
+  'overlapSummary': 'data/overlap.summary.json'
 }
 
 FIND_OVERLAP_DEFAULTS = {
@@ -31,6 +32,21 @@ FIND_OVERLAP_DEFAULTS = {
   'outputB': 'data/probes.overlap.bed',
   'output': 'data/overlap.bed',
   'keep': False,
+  'engine': 'bedtools',
+  'workers': 1,
+  #max # of inputs normalised and sorted (and intersected) at once. None for --workers, at least 2
+  'stepWorkers': None,
+  'sorter': 'gnu',
+  'sortMemory': '1G',
+  'cacheDir': 'data/cache',
+  'nearestDistance': 0,
+  'nearestOutput': 'data/nearest.bed',
+  'minFractionA': 0.0,
+  'minFractionB': 0.0,
+  'metrics': False,
+  'strand': None,
+  'batchDir': 'data/batch',
+  'transcripts': False,
 }
 
 BED_DEFAULTS = {
@@ -61,7 +77,34 @@ GET_ENSEMBL_PROBES_DEFAULTS = {
 			'probe_feature', 'seq_region'],
   'noDownload': False,
   'pandasPipeline': False,
-  'cleanUp': False
+  'cleanUp': False,
+  'sort': False,
+  'sortMemory': '1G',
+  'bgzip': False,
+  #max # of funcgen tables downloaded at once
+  'downloadWorkers': 4,
+  #join probe features against a compact NumPy table of probes rather than a dict
+  'lookupTable': False,
+  #how probe features are joined to probes: hash (probes held in memory) or merge (both streamed
+  # in probe id order)
+  'join': 'hash',
+  ## of processes creating the bed file from the probe features (hash join only)
+  'workers': 1,
+  #only keep probes on these arrays: 'curated' (those with a GPL in org_array_gpl.py), a comma
+  # separated list or a file of array names. None for all expression arrays.
+  'arrays': None,
+  #merge the probe features of each probe set into the intervals they cover
+  'collapseProbeSets': False,
+  #carry on from the checkpoint of an interrupted run rather than creating the bed file from scratch
+  'resume': False,
+  #batch mode: build these funcgen organisms at once instead of --organism. None for a single organism.
+  'organisms': None,
+  #shared cache of downloaded funcgen tables, in release-<RELEASE>/<ORGANISM>/ sub directories
+  'cacheDir': 'data/ensembl',
+  #each organism's bed and log go to a sub directory of this named after the organism
+  'batchDir': 'data/organisms',
+  ## of organisms built at once
+  'batchWorkers': 3
 }
 
 GET_GEO_DATASERIES_DEFAULTS = {
@@ -81,7 +124,8 @@ PARSE_GEO_DATASERIES_DEFAULTS = {
   'lncrnaFile': 'data/lncrnas.bed',
   'organism': 'homo_sapiens',
   'completedFilesFile': 'data/results/expressed_series/completed_files.txt',
-  'force': False
+  'force': False,
+  'nearestFile': ''
 }
 
 GET_LNCRNA_DEFAULTS = {
@@ -90,7 +134,9 @@ GET_LNCRNA_DEFAULTS = {
   'output': 'data/lncrnas.bed',
   'highconf': True,
   'lncipediaVersion': '5.2',
-  'noncodeVersion': 'v5'
+  'noncodeVersion': 'v5',
+  'sort': False,
+  'sortMemory': '1G'
 }
 
 #
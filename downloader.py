@@ -3,8 +3,11 @@
 # of some sites.
 
 import errno
+import ftplib
 import re
 import os
+import shutil
+import subprocess as sub
 import sys
 import urllib.request
 import urllib.error
@@ -61,6 +64,111 @@ def getUrl(url):
   data = response.read().decode('utf-8')
   return data
 
+#suffix of the temp file a download is streamed to before being moved to its output path
+PART_SUFFIX = '.part'
+#bytes read from the connection at once when streaming a download to disk
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+
+#streams the url to output, via a temp file at output + '.part'. if the temp file is already there
+# from an interrupted download, the transfer is resumed from its end with a REST offset (FTP) or a
+# Range header (HTTP), falling back to starting over if the server won't resume. the output only
+# appears once the whole file has been received, so a partial file is never mistaken for a
+# finished one.
+def resumableDownload(url, output, force=False):
+  if not force and os.path.isfile(output):
+    print(f'Output file {output} already exists, skipping download ...', file=sys.stdout)
+    return
+  createPathToFile(output)
+  part = output + PART_SUFFIX
+  offset = os.path.getsize(part) if os.path.isfile(part) else 0
+  if offset:
+    print(f'Resuming download of {url} to {output} from byte {offset} ...')
+  else:
+    print(f'Downloading {url} to {output} ...')
+  parsed = urllib.parse.urlparse(url)
+  if parsed.scheme == 'ftp':
+    with ftplib.FTP(parsed.hostname) as ftp:
+      ftp.login()
+      with open(part, 'ab') as f:
+        ftp.retrbinary('RETR ' + parsed.path, f.write, blocksize=STREAM_BLOCK_SIZE, rest=offset or None)
+  else:
+    user_agent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'
+    headers = {'User-Agent': user_agent}
+    if offset:
+      headers['Range'] = f'bytes={offset}-'
+    request = urllib.request.Request(url, None, headers)
+    try:
+      response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as err:
+      #416: the part file already holds the whole file (or more), start over to be safe
+      if err.code != 416:
+        raise err
+      remove(part)
+      return resumableDownload(url, output, force=True)
+    with response:
+      #a server ignoring the range sends the whole file with a 200
+      mode = 'ab' if offset and response.status == 206 else 'wb'
+      with open(part, mode) as f:
+        shutil.copyfileobj(response, f, STREAM_BLOCK_SIZE)
+  os.replace(part, output)
+
+#parses a CHECKSUMS file, as found in each Ensembl FTP directory, from the url. its lines are the
+# output of the BSD sum program: checksum, # of 1K blocks, file name.
+#@return a map of file name to (checksum, blocks), or None if the file couldn't be fetched
+def getChecksums(url):
+  try:
+    data = getUrl(url)
+  except (urllib.error.URLError, OSError) as err:
+    print(f'Could not fetch checksums at {url}: {err}', file=sys.stderr)
+    return None
+  checksums = {}
+  for line in data.splitlines():
+    cols = line.split()
+    if len(cols) >= 3:
+      checksums[cols[2]] = (int(cols[0]), int(cols[1]))
+  return checksums
+
+#computes the BSD sum checksum of a file (as sum -r): a 16 bit rotating checksum, plus the file
+# size in 1K blocks. uses the sum program if available since it's much quicker on big files.
+#@return (checksum, blocks)
+def bsdSum(path):
+  if shutil.which('sum'):
+    proc = sub.run(['sum', '-r', path], stdout=sub.PIPE, text=True, check=True)
+    cols = proc.stdout.split()
+    return (int(cols[0]), int(cols[1]))
+  checksum = 0
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b''):
+      for byte in block:
+        checksum = (((checksum >> 1) | ((checksum & 1) << 15)) + byte) & 0xffff
+  return (checksum, (os.path.getsize(path) + 1023) // 1024)
+
+#downloads the url to output with resumableDownload and checks it against its expected
+# (checksum, blocks) from getChecksums. an existing output that doesn't match is treated as a
+# partial download and resumed; if the result still doesn't match it's fetched again from scratch,
+# up to retries times, before giving up with an IOError. with no expected checksum the download
+# isn't verified.
+def verifiedDownload(url, output, expected=None, retries=2):
+  if expected is None:
+    resumableDownload(url, output)
+    return
+  if os.path.isfile(output):
+    if bsdSum(output) == expected:
+      print(f'Output file {output} already exists and matches its checksum, skipping download ...')
+      return
+    print(f'Output file {output} does not match its checksum, resuming download ...', file=sys.stderr)
+    os.replace(output, output + PART_SUFFIX)
+  for attempt in range(retries + 1):
+    resumableDownload(url, output)
+    actual = bsdSum(output)
+    if actual == expected:
+      return
+    print(f'Checksum mismatch for {output} (expected {expected}, got {actual}), ' + \
+        'downloading again ...', file=sys.stderr)
+    remove(output)
+  raise IOError(f'Could not download {url} with a matching checksum after {retries + 1} attempts')
+
 #returns list of files and file sizes for a folder specified by the url.
 #not tested for files with spaces in names.
 #format returned from urllib/ftplib is like:
@@ -29,6 +29,7 @@ import urllib.parse
 import downloader
 import geotools
 import ncbitools
+import overlaptools
 import constants as c
 import find_geo_platforms as plat
 
@@ -56,6 +57,15 @@ def getArraysFromProbeOverlapBed(probeOverlapFile):
     print('Error: could not get arrays from %s' % probeOverlapFile)
   return arrays
 
+#get the array names from the find_overlap.py summary sidecar of a probe overlap file, avoiding a scan
+# of the file itself.
+#@return arrays - a set of array names, or None if the summary is missing or not for probeOverlapFile
+def getArraysFromOverlapSummary(summaryFile, probeOverlapFile):
+  summary = overlaptools.readOverlapSummary(summaryFile, 'outputB', probeOverlapFile)
+  if summary is None or 'arrays' not in summary:
+    return None
+  return set(summary['arrays'])
+
 #get sizes of all series matrix files present on FTP server
 def getSeriesMatrixFileInfo(seriesIds, ftp):
   info = {}
@@ -143,7 +153,7 @@ def searchForAllDataSetSeries(organism, searchTerms, esearchFile, esummaryFile):
 
 def usage(defaults):
   print('Usage: ' + sys.argv[0] + \
-      ' -o, --organism <STRING> -d, --data-dir <DIRECTORY> -t, --search-terms <STRING> -p, --get-platforms-from-overlap <PROBE_OVERLAP_FILE> --esearch <ESEARCH_OUTPUT> --esummary <ESUMMARY_OUTPUT> --series-output <SERIES_IDS_OUTPUT> --info-output <SUMMARY_INFO_OUTPUT>')
+      ' -o, --organism <STRING> -d, --data-dir <DIRECTORY> -t, --search-terms <STRING> -p, --get-platforms-from-overlap <PROBE_OVERLAP_FILE> --overlap-summary <SUMMARY_FILE> --esearch <ESEARCH_OUTPUT> --esummary <ESUMMARY_OUTPUT> --series-output <SERIES_IDS_OUTPUT> --info-output <SUMMARY_INFO_OUTPUT>')
   print('Example: ' + sys.argv[0] + ' -o homo_sapiens -t "asthma"')
   print('Defaults:')
   for key, val in sorted(iter(defaults.items()), key=operator.itemgetter(0)):
@@ -154,7 +164,7 @@ def __main__():
   longOpts = ['help', 'ftp=', 'organism=', 'data-dir=', 'search-terms=', 
       'esearch=', 'esummary=', 'series-output=', 'info-output=',
       'get-all-platforms', 'get-platforms-from-overlap=', 
-      'skip-series-info', 'allow-data-series']
+      'skip-series-info', 'allow-data-series', 'overlap-summary=']
   defaults = c.FIND_GEO_DATASERIES_DEFAULTS
   ftp = defaults['ftp']
   organism = defaults['organism']
@@ -168,6 +178,7 @@ def __main__():
   getPlatformsFromOverlap = defaults['getPlatformsFromOverlap']
   skipSeriesInfo = defaults['skipSeriesInfo']
   gdsOnly = defaults['gdsOnly']
+  overlapSummary = defaults['overlapSummary']
   try:
     opts, args = getopt.getopt(sys.argv[1:], shortOpts, longOpts)
   except getopt.GetoptError as err:
@@ -203,6 +214,8 @@ def __main__():
       getPlatformsFromOverlap = arg
     elif opt in ('-s', '--allow-data-series'):
       gdsOnly = False
+    elif opt == '--overlap-summary':
+      overlapSummary = arg
   #get relevant GEO platforms
   if getAllPlatforms:
     #significantly slower, this gets all GEO platforms related to Ensembl arrays
@@ -213,7 +226,11 @@ def __main__():
     #might be a moot point for large overlap files with most of the Ensembl arrays.
     print('Getting relevant GEO platforms ...')
     probeOverlapFile = getPlatformsFromOverlap
-    arrays = getArraysFromProbeOverlapBed(probeOverlapFile)
+    arrays = getArraysFromOverlapSummary(overlapSummary, probeOverlapFile)
+    if arrays is None:
+      arrays = getArraysFromProbeOverlapBed(probeOverlapFile)
+    else:
+      print(f'Read arrays from overlap summary {overlapSummary}')
     print(f'Found {len(arrays) or 0} arrays from probe overlap BED file')
     platforms = set([])
     for array in arrays:
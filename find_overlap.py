@@ -2,30 +2,49 @@
 # Script to evaluate the chromosome positional overlap between two BED files.
 # Will use this to find out which lncRNAs have overlapping expression probe data.
 #
-# Depends on: bedtools, sort
+# Depends on: bedtools (unless --engine native), sort (unless --sorter python)
+#
+# Inputs are normalised in a single streaming pass: non-standard chromosomes are dropped and
+#  BED-12 blocks expanded to BED-6 on the fly, feeding straight into sort so that only the final
+#  sorted file is written to disk.
 #
 # Note: in this tool both input A and input B are normalised, and both A and B have overlap files output.
 #  But in the lncRNA + probe overlap workflow, only lncRNAs need to be normalised, and only probes need a 
 #  separate overlap file.
 #
 
+import concurrent.futures
 import datetime
 import getopt
+import hashlib
 import operator
 import os
 import pathlib
 import re
+import shutil
 import sys
 import subprocess as sub
+import tempfile
 
 #local
+import arraytools
+import bgzftools
 import constants as c
+import downloader
+import overlaptools
+import sorttools
 
 
 def usage(defaults):
   print('Usage: ' + sys.argv[0] + \
       ' -a, --input-a <BED_INPUT_A> -b, --input-b <BED_INPUT_B> -A,' + \
       ' --output-a <OVERLAP_A_OUTPUT> -B, --output-b <OVERLAP_B_OUTPUT>' + \
+      ' -e, --engine <bedtools|native> -w, --workers <N> --step-workers <N>' + \
+      ' -s, --sorter <gnu|python> --sort-memory <SIZE>' + \
+      ' -C, --cache-dir <DIRECTORY> --no-cache' + \
+      ' -n, --nearest-distance <BP> -N, --nearest-output <NEAREST_OUTPUT>' + \
+      ' -f, --min-fraction-a <FRACTION> -F, --min-fraction-b <FRACTION> -m, --metrics' + \
+      ' --strand <same|opposite> --batch-dir <DIRECTORY> -t, --transcripts' + \
       ' <BED_OUTPUT>\n')
   print('Example: ' + sys.argv[0] + \
       ' -a data/ensembl_probe_features.bed -b data/noncode_lncrnas.bed data/overlap.bed\n')
@@ -33,7 +52,31 @@ def usage(defaults):
   for key, val in sorted(iter(defaults.items()), key=operator.itemgetter(0)):
     print(str(key) + ' - ' + str(val))
   print('IMPORTANT:')
-  print('- bedtools and sort must be installed and on your $PATH\n')
+  print('- bedtools and sort must be installed and on your $PATH (bedtools not needed with --engine native,')
+  print('  sort not needed with --sorter python)')
+  print('- with --workers > 1 the overlap is computed per chromosome in parallel; output is unchanged')
+  print('- up to --step-workers inputs are normalised and sorted (and intersected) at once, each using')
+  print('  up to --sort-memory. Defaults to --workers, or 2 with a single worker')
+  print('- normalised, sorted inputs are cached in --cache-dir by content hash and reused by later runs;')
+  print('  delete the directory to reclaim the space')
+  print('- with --nearest-distance > 0, A features with no overlap are written to --nearest-output with')
+  print('  their closest B features within that many bp, plus a distance column (bedtools closest -d)')
+  print('- overlaps covering less than --min-fraction-a of A or --min-fraction-b of B are dropped')
+  print('  (bedtools intersect -f/-F)')
+  print('- --metrics appends overlap bp, fraction of A and fraction of B covered to <BED_OUTPUT>')
+  print('  (requires --engine native)')
+  print('- --strand same or opposite only matches features on the same or opposite strand, e.g. sense')
+  print('  or antisense probes of a lncRNA (bedtools intersect -s/-S); unstranded features never match')
+  print('- -a may be given more than once to overlap several inputs with the same B (batch mode). Each')
+  print('  input gets the usual output files in its own directory in --batch-dir, named after the input.')
+  print('  With --engine native B is read and indexed once for all inputs, and --workers is not used')
+  print('- --transcripts keeps BED-12 A features whole and writes one line per A/B pair to <BED_OUTPUT>:')
+  print('  A as BED-6, B, then the number of A blocks (exons) overlapping B, before any --metrics columns,')
+  print('  which are summed over the blocks (requires --engine native)')
+  print('- <BED_INPUT_B> may be a BED-6 file compressed and indexed by get_ensembl_probes.py --bgzip')
+  print('  (or bgzip and tabix -p bed), e.g. data/probes.bed.gz. Only the parts of it near A are read')
+  print('- a JSON summary of the outputs (arrays and probe set counts, per chromosome counts, input')
+  print('  fingerprints) is written next to <BED_OUTPUT>, e.g. data/overlap.summary.json\n')
 
 
 def run(cmd: str):
@@ -49,72 +92,224 @@ def esc(path: str) -> str:
   return f'"{path}"'
 
 
-def discardNonStdChrom(bedPath: str) -> str:
+STD_CHROM_PATTERN = re.compile('^chr[0-9A-Z]+$')
+#everything that changes the normalised, sorted output of an input file. part of the cache key,
+# so bump the version whenever iterNormalizedBed or the sort order changes. {blocks} is bed12tobed6
+# when BED-12 blocks are expanded and bed12 when they are kept.
+NORMALIZE_SETTINGS = 'v1;stdchr=' + STD_CHROM_PATTERN.pattern + ';{blocks};sort=-k1,1-k2,2n'
+
+
+def iterNormalizedBed(bed6or12path: str, expandBlocks: bool = True):
   '''
-  Discards all lines in BED file where the chromosome string is non-standard i.e. not chr1, chr2, ... chrM, chrX, chrY.
-  Needed because bedtools intersect complains about chromosomes with non-standard chars not being sorted lexicographically, even if they are.
+  Streams normalised BED-6 lines from a BED-6 or BED-12 file in a single pass.
+  Lines on non-standard chromosomes (not chr1, chr2, ... chrM, chrX, chrY) are discarded, as bedtools
+  intersect complains they aren't sorted lexicographically even when they are, and BED-12 features are
+  expanded to one line per block (as in bedtools bed12tobed6). Lines with fewer than 12 columns are
+  passed through unchanged.
+
+  Args:
+    bed6or12path (str): Path to input BED file, formatted in BED-6 or BED-12 (column) format.
+    expandBlocks (bool): Whether to expand BED-12 features. If not, they are passed through unchanged
+      for the native engine's --transcripts mode.
+
+  Yields:
+    str: Normalised BED-6 line, newline terminated.
   '''
-  print(f'Discarding non-standard chromosomes in: {bedPath} @ {datetime.datetime.now()} ...')
-  path = safePath(bedPath)
+  path = safePath(bed6or12path)
   if not path.endswith('.bed'):
     raise ValueError('Must pass valid .bed file to normalize!')
-  out = os.path.splitext(path)[0] + '.stdchr.bed'
-  with open(out, 'w') as output:
-    with open(path, 'r') as input:
-      pattern = re.compile('^chr[0-9A-Z]+$')
-      for line in input:
-        if not line.startswith('chr'):
-          continue
-        chr = line.split()[0]
-        if not pattern.match(chr):
-          continue
-        output.write(line)
-  return out
-
-
-def normalizeToBed6(bed6or12path: str) -> str:
+  with open(path, 'r') as input:
+    for line in input:
+      if not line.startswith('chr'):
+        continue
+      cols = line.rstrip('\r\n').split('\t')
+      if not STD_CHROM_PATTERN.match(cols[0]):
+        continue
+      if len(cols) < 12 or not expandBlocks:
+        yield '\t'.join(cols) + '\n'
+        continue
+      #BED-12 columns: chrom, start, end, name, score, strand, thickStart, thickEnd, rgb,
+      # blockCount, blockSizes, blockStarts. sizes and starts are comma delimited with a trailing comma.
+      chrom, start, name, score, strand = cols[0], int(cols[1]), cols[3], cols[4], cols[5]
+      blockCount = int(cols[9])
+      blockSizes = cols[10].rstrip(',').split(',')
+      blockStarts = cols[11].rstrip(',').split(',')
+      for i in range(blockCount):
+        blockStart = start + int(blockStarts[i])
+        blockEnd = blockStart + int(blockSizes[i])
+        yield f'{chrom}\t{blockStart}\t{blockEnd}\t{name}\t{score}\t{strand}\n'
+
+
+def sortLines(lines, output: str, sorter: str = 'gnu', sortMemory: str = '1G',
+    chunksize: int = 50000):
   '''
-  Normalises bed12 or bed6 file at input path and writes to and returns output bed6 file.
-  Requires bedtools to be on path.
+  Sorts BED lines from an iterable into the output file, grouping features by chromosome
+  alphabetically and then by start position numerically. Lines are piped into the sorter so that no
+  unsorted intermediary file is written. For GNU sort the C locale is forced so the chromosome order
+  is plain lexicographic, which is what bedtools -sorted expects and what sorttools produces.
 
-  ref: https://bedtools.readthedocs.io/en/latest/content/tools/bed12tobed6.html
+  Args:
+    lines (iterable): Newline terminated BED lines.
+    output (str): Path to sorted output BED file.
+    sorter (str): 'gnu' to pipe into unix sort, 'python' for the sorttools external merge sort.
+    sortMemory (str): Memory budget for the python sorter's sorted runs, e.g. 512M.
+    chunksize (int): Number of lines to buffer per write to sort.
+  '''
+  if sorter == 'python':
+    print(f'Sorting to {esc(output)} with a {sortMemory} memory budget @ {datetime.datetime.now()} ...')
+    sorttools.sortBedLines(lines, output, sortMemory)
+    return
+  env = dict(os.environ, LC_ALL='C')
+  print(f'Running: sort -k1,1 -k2,2n > {esc(output)} @ {datetime.datetime.now()} ...')
+  with open(output, 'w') as out:
+    proc = sub.Popen(['sort', '-k1,1', '-k2,2n'], stdin=sub.PIPE, stdout=out, env=env, text=True)
+    for chunk in arraytools.getChunks(lines, chunksize):
+      proc.stdin.write(''.join(chunk))
+    proc.stdin.close()
+    returncode = proc.wait()
+  if returncode != 0:
+    raise RuntimeError(f'sort exited with code {returncode} writing {output}')
+
+
+def normalizeAndSortBed(bed6or12path: str, sorter: str = 'gnu', sortMemory: str = '1G',
+    output: str = None, expandBlocks: bool = True) -> str:
+  '''
+  Discards non-standard chromosomes, expands BED-12 to BED-6 and sorts the input in one streaming
+  pass. Input marked as already sorted by sorttools.SORTED_MARKER is only checked, not sorted again.
+  Only the final sorted file is written to disk. It is written to a temporary file unique to this
+  run and moved into place once complete, so a partially written file is never mistaken for a cached
+  one and concurrent runs over the same input don't clobber each other.
 
   Args:
     bed6or12path (str): Path to input BED file, formatted in BED-6 or BED-12 (column) format.
+    sorter (str): See sortLines.
+    sortMemory (str): See sortLines.
+    output (str): Path to write to. Defaults to getSortedPath(bed6or12path, expandBlocks).
+    expandBlocks (bool): See iterNormalizedBed.
 
   Returns:
-    str: Path to sorted output BED file.
+    str: Path to normalised and sorted output BED file.
   '''
-  path = safePath(bed6or12path)
-  if not path.endswith('.bed'):
-    raise ValueError('Must pass valid .bed file to normalize!')
-  out = os.path.splitext(path)[0] + '.bed6.bed'
-  cmd = f'bedtools bed12tobed6 -i {esc(path)} > {esc(out)}'
-  run(cmd)
+  out = output or getSortedPath(bed6or12path, expandBlocks)
+  #a temporary file of its own, so concurrent runs over the same input can't write into each other's
+  fd, tmp = tempfile.mkstemp(prefix=f'{os.path.basename(out)}.', suffix='.tmp',
+      dir=os.path.dirname(os.path.abspath(out)))
+  os.close(fd)
+  #mkstemp makes it private, but the cache is shared: give it the permissions open() would have
+  umask = os.umask(0)
+  os.umask(umask)
+  os.chmod(tmp, 0o666 & ~umask)
+  try:
+    if sorttools.isMarkedSorted(safePath(bed6or12path)):
+      print(f'Normalising (already sorted): {bed6or12path} @ {datetime.datetime.now()} ...')
+      if writeIfSorted(iterNormalizedBed(bed6or12path, expandBlocks), tmp):
+        os.replace(tmp, out)
+        return out
+      print(f'{bed6or12path} is marked sorted but is out of order, sorting it anyway ...', file=sys.stderr)
+    print(f'Normalising and sorting: {bed6or12path} @ {datetime.datetime.now()} ...')
+    sortLines(iterNormalizedBed(bed6or12path, expandBlocks), tmp, sorter, sortMemory)
+    os.replace(tmp, out)
+  except BaseException:
+    downloader.remove(tmp)
+    raise
   return out
 
 
-def sortBed(bedPath: str) -> str:
+def writeIfSorted(lines, output: str) -> bool:
   '''
-  Sorts a BED file grouping features by chromosome alphabetically, and then by start position numerically.
-  Requires unix sort command to be on path.
+  Writes BED lines to the output file as long as they are in sorted order (see sortLines), e.g. those
+  of a file written pre-sorted by get_ensembl_probes.py --sort, checking the order as they go.
+
+  Returns:
+    bool: Whether all the lines were in order and written. If not, the output is incomplete.
+  '''
+  previous = None
+  with open(output, 'w') as out:
+    for line in lines:
+      key = sorttools.getBedKey(line) + (line,)
+      if previous is not None and key < previous:
+        return False
+      out.write(line)
+      previous = key
+  return True
+
+
+def getSortedPath(bedPath: str, expandBlocks: bool = True) -> str:
+  '''
+  Returns the path normalizeAndSortBed writes the sorted version of a BED file to.
+  '''
+  suffix = '.sorted.bed' if expandBlocks else '.bed12.sorted.bed'
+  return os.path.splitext(safePath(bedPath))[0] + suffix
+
+
+def getRegionsPath(indexedBed: str) -> str:
+  '''
+  Returns the path extractIndexedRegions writes the regions of an indexed BED file to.
+  '''
+  return re.sub(r'(\.bed)?\.gz$', '', safePath(indexedBed)) + '.regions.bed'
+
+
+def extractIndexedRegions(sortedAs: list, indexedBed: str, output: str, padding: int = 0) -> str:
+  '''
+  Writes the features of a sorted, indexed BED-6 file (see bgzftools, get_ensembl_probes.py --bgzip)
+  lying within padding bp of any feature in the sorted A files to output, reading only the blocks of
+  the indexed file that contain them. The output is sorted like normalizeAndSortBed output, so can be
+  used as B in its place, but only holds the features of B that could overlap A.
 
   Args:
-    bedPath (str): Path to input BED file.
+    sortedAs (list): Paths to normalised, sorted BED files.
+    indexedBed (str): Path to a BGZF compressed BED file with a .tbi index next to it.
+    output (str): Path to write the features to.
+    padding (int): Distance around each A feature to include.
 
   Returns:
-    str: Path to sorted output BED file.
+    str: Path to output.
   '''
-  path = safePath(bedPath)
-  if not path.endswith('.bed'):
-    raise ValueError('Must pass valid .bed file to normalize!')
-  out = os.path.splitext(path)[0] + '.sorted.bed'
-  cmd = f'sort -k1,1 -k2,2n {esc(path)} > {esc(out)}'
-  run(cmd)
-  return out
+  print(f'Reading the regions of {indexedBed} near A features @ {datetime.datetime.now()} ...')
+  regions = []
+  for sortedA in sortedAs:
+    with open(sortedA, 'r') as a:
+      for (chrom, start, end, strand, line) in overlaptools.iterBedRecords(a):
+        regions.append((chrom, max(start - padding, 0), end + padding))
+  #chromosomes in the same (C locale) order as the sorted files
+  regions.sort()
+  tmp = f'{output}.tmp'
+  with open(tmp, 'w') as out:
+    out.writelines(bgzftools.iterRegionLines(indexedBed, regions))
+  os.replace(tmp, output)
+  return output
+
+
+def getFileHash(path: str, blocksize: int = 1 << 20) -> str:
+  '''
+  Returns the hex SHA-256 digest of a file's contents.
+  '''
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(blocksize), b''):
+      h.update(block)
+  return h.hexdigest()
+
+
+def getCachedSortedPath(bedPath: str, cacheDir: str, expandBlocks: bool = True,
+    fileHashes: dict = None) -> str:
+  '''
+  Returns the path in the cache directory for the normalised, sorted version of a BED file.
+  The name is keyed on a hash of the file's contents and the normalisation settings, so an unchanged
+  input maps to the same cached file across runs regardless of its path or modification time.
+  The file's hash is looked up in and added to fileHashes (path -> hash) if given.
+  '''
+  fileHashes = {} if fileHashes is None else fileHashes
+  if bedPath not in fileHashes:
+    print(f'Hashing {bedPath} for the sorted BED cache @ {datetime.datetime.now()} ...')
+    fileHashes[bedPath] = getFileHash(bedPath)
+  settings = NORMALIZE_SETTINGS.format(blocks='bed12tobed6' if expandBlocks else 'bed12')
+  key = hashlib.sha256(f'{settings};{fileHashes[bedPath]}'.encode()).hexdigest()
+  stem = os.path.splitext(os.path.basename(bedPath))[0]
+  return os.path.join(safePath(cacheDir), f'{stem}.{key[:16]}.sorted.bed')
 
 
-def getOverlapping(inputA: str, inputB: str, output: str):
+def getOverlapping(inputA: str, inputB: str, output: str, flags: str = ''):
   '''
   Gets genomic features in A that overlap positions in B, writing them to output file.
   Only features in A that overlap are written out. No features in B are written to output.
@@ -125,12 +320,13 @@ def getOverlapping(inputA: str, inputB: str, output: str):
     inputA (str): Path to input BED file A.
     inputB (str): Path to input BED file B.
     output (str): Path to output file to write to.
+    flags (str): Extra bedtools intersect flags, see getBedtoolsFlags.
   '''
-  cmd = f'bedtools intersect -a {esc(safePath(inputA))} -b {esc(safePath(inputB))} -sorted -u > {esc(safePath(output))}'
+  cmd = f'bedtools intersect -a {esc(safePath(inputA))} -b {esc(safePath(inputB))} -sorted -u{flags} > {esc(safePath(output))}'
   run(cmd)
 
 
-def getOverlap(inputA: str, inputB: str, output: str):
+def getOverlap(inputA: str, inputB: str, output: str, flags: str = ''):
   '''
   Get overlap of genomic features in sorted BED files A and B and write the overlap out to output BED-like file.
   The output file will have one line for each overlap, first feature A columns then feature B columns.
@@ -143,21 +339,213 @@ def getOverlap(inputA: str, inputB: str, output: str):
     inputA (str): Path to input BED file A.
     inputB (str): Path to input BED file B.
     output (str): Path to output file to write to.
+    flags (str): Extra bedtools intersect flags, see getBedtoolsFlags.
   '''
-  cmd = f'bedtools intersect -a {esc(safePath(inputA))} -b {esc(safePath(inputB))} -sorted -wa -wb > {esc(safePath(output))}'
+  cmd = f'bedtools intersect -a {esc(safePath(inputA))} -b {esc(safePath(inputB))} -sorted -wa -wb{flags} > {esc(safePath(output))}'
   run(cmd)
 
 
+def getBedtoolsFlags(options: dict, swap: bool = False) -> str:
+  '''
+  Translates native engine options into bedtools intersect flags.
+
+  Args:
+    options (dict): Options as passed to overlaptools.intersectRecords.
+    swap (bool): Whether A and B are swapped for this call, e.g. for outputB.
+
+  Returns:
+    str: Flags, each preceded by a space.
+  '''
+  minFractionA = options.get('minFractionA', 0)
+  minFractionB = options.get('minFractionB', 0)
+  if swap:
+    (minFractionA, minFractionB) = (minFractionB, minFractionA)
+  flags = ''
+  if options.get('strandMode') == 'same':
+    flags += ' -s'
+  elif options.get('strandMode') == 'opposite':
+    flags += ' -S'
+  if minFractionA > 0:
+    flags += f' -f {minFractionA}'
+  if minFractionB > 0:
+    flags += f' -F {minFractionB}'
+  return flags
+
+
+def getOverlapBedtools(sortedA: str, sortedB: str, output: str, outputA: str, outputB: str,
+    options: dict = None):
+  '''
+  Runs the three bedtools intersect calls for sorted files A and B.
+  '''
+  options = options or {}
+  getOverlapping(sortedA, sortedB, outputA, getBedtoolsFlags(options))
+  getOverlapping(sortedB, sortedA, outputB, getBedtoolsFlags(options, swap=True))
+  getOverlap(sortedA, sortedB, output, getBedtoolsFlags(options))
+
+
+def getBatchQueries(inputsA: list, batchDir: str, output: str, outputA: str, outputB: str,
+    nearestOutput: str = None) -> list:
+  '''
+  Names the outputs of each input A in a batch: the usual output file names, in a directory per input
+  named after the input's file name without extension.
+
+  Returns:
+    list: (inputA, output, outputA, outputB, nearestOutput) tuples. nearestOutput is None if not given.
+  '''
+  queries = []
+  for inputA in inputsA:
+    queryDir = os.path.join(batchDir, os.path.splitext(os.path.basename(inputA))[0])
+    if any(query[1].startswith(queryDir + os.sep) for query in queries):
+      raise ValueError(f'Batch inputs must have distinct file names: {inputA}')
+    downloader.createPathToFile(safePath(queryDir) + '/')
+    paths = (output, outputA, outputB, nearestOutput)
+    queries.append((inputA,) + tuple(os.path.join(queryDir, os.path.basename(path)) if path else None
+        for path in paths))
+  return queries
+
+
+def runSteps(steps: dict, workers: int) -> dict:
+  '''
+  Runs a small dependency graph of steps in a process pool. Each step is started as soon as all the
+  steps it depends on have finished, so the wall time is that of the critical path rather than the
+  sum of all steps.
+
+  Args:
+    steps (dict): Step name -> (tuple of step names depended on, function, tuple of args), optionally
+      followed by a dict of keyword args.
+    workers (int): Maximum number of steps to run at once.
+
+  Returns:
+    dict: Step name -> return value of the step's function.
+  '''
+  results = {}
+  running = {}
+  pending = dict(steps)
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+    while pending or running:
+      for (name, (deps, fn, args, *kwargs)) in list(pending.items()):
+        if all(dep in results for dep in deps):
+          running[executor.submit(fn, *args, **(kwargs[0] if kwargs else {}))] = name
+          del pending[name]
+      if not running:
+        raise ValueError(f'Unsatisfiable step dependencies: {sorted(pending)}')
+      done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        #re-raises any exception from the step
+        results[running.pop(future)] = future.result()
+  return results
+
+
+def getChromOverlap(engine: str, chrom: str, sortedA: str, rangeA: tuple, sortedB: str, rangeB: tuple,
+    partsDir: str, options: dict) -> tuple:
+  '''
+  Computes the overlap of a single chromosome given the byte ranges of the chromosome in sorted files
+  A and B. Run in a worker process by getOverlapParallel.
+
+  Returns:
+    tuple: Paths to the chromosome's (output, outputA, outputB, nearestOutput) part files, the nearest
+      part None unless options has a maxDistance, and the overlaptools.OverlapCounts of the parts
+      (None with the bedtools engine).
+  '''
+  parts = tuple(os.path.join(partsDir, f'{chrom}.{suffix}.bed') for suffix in ('ab', 'a', 'b', 'n'))
+  if not options.get('maxDistance'):
+    parts = parts[:3] + (None,)
+  recordsA = overlaptools.iterBedRecords(overlaptools.iterRangeLines(sortedA, *rangeA))
+  recordsB = overlaptools.iterBedRecords(overlaptools.iterRangeLines(sortedB, *rangeB))
+  counts = None
+  if engine == 'native':
+    counts = overlaptools.OverlapCounts()
+    files = [open(part, 'w') if part else None for part in parts]
+    try:
+      overlaptools.intersectRecords(recordsA, recordsB, *files, counts=counts, **options)
+    finally:
+      for f in files:
+        if f is not None:
+          f.close()
+  else:
+    chromA = os.path.join(partsDir, f'{chrom}.input.a.bed')
+    chromB = os.path.join(partsDir, f'{chrom}.input.b.bed')
+    for (source, (start, end), dest) in ((sortedA, rangeA, chromA), (sortedB, rangeB, chromB)):
+      with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        src.seek(start)
+        dst.write(src.read(end - start))
+    getOverlapBedtools(chromA, chromB, *parts[:3], options)
+    if parts[3]:
+      overlaptools.intersectSortedFiles(chromA, chromB, nearestOutput=parts[3], **options)
+  return parts, counts
+
+
+def getOverlapParallel(engine: str, sortedA: str, sortedB: str, output: str, outputA: str,
+    outputB: str, workers: int, nearestOutput: str = None, options: dict = None):
+  '''
+  Partitions sorted files A and B by chromosome, computes the overlap of each chromosome in a process
+  pool, and concatenates the results in sorted chromosome order. Since overlap never crosses
+  chromosomes the outputs are identical to the serial run.
+
+  Returns:
+    overlaptools.OverlapCounts: The merged counts of the chromosomes, or None with the bedtools engine.
+  '''
+  print(f'Partitioning inputs by chromosome for {workers} workers @ {datetime.datetime.now()} ...')
+  offsetsA = overlaptools.getChromOffsets(sortedA)
+  offsetsB = overlaptools.getChromOffsets(sortedB)
+  chroms = sorted(set(offsetsA).intersection(offsetsB))
+  partsDir = tempfile.mkdtemp(prefix='overlap.parts.', dir=os.path.dirname(safePath(output)))
+  options = dict(options or {})
+  if not nearestOutput:
+    options['maxDistance'] = 0
+  try:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+      futures = [executor.submit(getChromOverlap, engine, chrom, sortedA, offsetsA[chrom],
+          sortedB, offsetsB[chrom], partsDir, options) for chrom in chroms]
+      #results are collected in chromosome order, not completion order
+      chromParts = []
+      counts = overlaptools.OverlapCounts() if engine == 'native' else None
+      for future in futures:
+        (parts, chromCounts) = future.result()
+        chromParts.append(parts)
+        if counts is not None:
+          counts.merge(chromCounts)
+    print(f'Concatenating {len(chromParts)} chromosome outputs @ {datetime.datetime.now()} ...')
+    outputs = (output, outputA, outputB, nearestOutput if options.get('maxDistance') else None)
+    for (i, path) in enumerate(outputs):
+      if not path:
+        continue
+      with open(safePath(path), 'wb') as out:
+        for parts in chromParts:
+          with open(parts[i], 'rb') as part:
+            shutil.copyfileobj(part, out)
+  finally:
+    shutil.rmtree(partsDir, ignore_errors=True)
+  return counts
+
+
 def __main__():
-  shortOpts = 'ha:b:A:B:o:k'
-  longOpts = ['help', 'input-a=', 'input-b=', 'output-a=', 'output-b=', 'output=', 'keep']
+  shortOpts = 'ha:b:A:B:o:ke:w:s:C:n:N:f:F:mt'
+  longOpts = ['help', 'input-a=', 'input-b=', 'output-a=', 'output-b=', 'output=', 'keep',
+      'engine=', 'workers=', 'sorter=', 'sort-memory=', 'cache-dir=', 'no-cache',
+      'nearest-distance=', 'nearest-output=', 'min-fraction-a=', 'min-fraction-b=', 'metrics',
+      'strand=', 'batch-dir=', 'transcripts', 'step-workers=']
   defaults = c.FIND_OVERLAP_DEFAULTS
-  inputA = defaults['inputA']
+  inputsA = []
   inputB = defaults['inputB']
   outputA = defaults['outputA']
   outputB = defaults['outputB']
   output = defaults['output']
   keep = defaults['keep']
+  engine = defaults['engine']
+  workers = defaults['workers']
+  sorter = defaults['sorter']
+  sortMemory = defaults['sortMemory']
+  cacheDir = defaults['cacheDir']
+  maxDistance = defaults['nearestDistance']
+  nearestOutput = defaults['nearestOutput']
+  minFractionA = defaults['minFractionA']
+  minFractionB = defaults['minFractionB']
+  metrics = defaults['metrics']
+  strandMode = defaults['strand']
+  batchDir = defaults['batchDir']
+  transcripts = defaults['transcripts']
+  stepWorkers = defaults['stepWorkers']
   try:
     opts, args = getopt.getopt(sys.argv[1:], shortOpts, longOpts)
   except getopt.GetoptError as err:
@@ -169,7 +557,7 @@ def __main__():
       usage(defaults)
       sys.exit()
     elif opt in ('-a', '--input-a'):
-      inputA = arg
+      inputsA.append(arg)
     elif opt in ('-b', '--input-b'):
       inputB = arg
     elif opt in ('-A', '--output-a'):
@@ -180,29 +568,162 @@ def __main__():
       output = arg
     elif opt in ('-k', '--keep'):
       keep = True
+    elif opt in ('-e', '--engine'):
+      engine = arg
+    elif opt in ('-w', '--workers'):
+      workers = int(arg)
+    elif opt in ('-s', '--sorter'):
+      sorter = arg
+    elif opt == '--sort-memory':
+      sortMemory = arg
+    elif opt in ('-C', '--cache-dir'):
+      cacheDir = arg
+    elif opt == '--no-cache':
+      cacheDir = None
+    elif opt in ('-n', '--nearest-distance'):
+      maxDistance = int(arg)
+    elif opt in ('-N', '--nearest-output'):
+      nearestOutput = arg
+    elif opt in ('-f', '--min-fraction-a'):
+      minFractionA = float(arg)
+    elif opt in ('-F', '--min-fraction-b'):
+      minFractionB = float(arg)
+    elif opt in ('-m', '--metrics'):
+      metrics = True
+    elif opt == '--strand':
+      strandMode = arg
+    elif opt == '--batch-dir':
+      batchDir = arg
+    elif opt in ('-t', '--transcripts'):
+      transcripts = True
+    elif opt == '--step-workers':
+      stepWorkers = int(arg)
+  if sorter not in ('gnu', 'python'):
+    print(f'Unknown sorter: {sorter}', file=sys.stderr)
+    usage(defaults)
+    sys.exit(2)
+  if engine not in ('bedtools', 'native'):
+    print(f'Unknown overlap engine: {engine}', file=sys.stderr)
+    usage(defaults)
+    sys.exit(2)
+  if strandMode not in (None, 'same', 'opposite'):
+    print(f'Unknown strand mode: {strandMode}', file=sys.stderr)
+    usage(defaults)
+    sys.exit(2)
+  if metrics and engine != 'native':
+    print('Overlap --metrics require --engine native', file=sys.stderr)
+    usage(defaults)
+    sys.exit(2)
+  if transcripts and engine != 'native':
+    print('Overlap --transcripts requires --engine native', file=sys.stderr)
+    usage(defaults)
+    sys.exit(2)
   if len(args) > 0 and output == defaults['output']:
     # Only assume first argument is output if user didn't specify an --output arg
     output = args[0]
+  if not inputsA:
+    inputsA = [defaults['inputA']]
+  if not stepWorkers:
+    #A and B are normalised and sorted at the same time even with a single worker
+    stepWorkers = max(workers, 2)
+  if maxDistance <= 0:
+    nearestOutput = None
+  #one (inputA, output, outputA, outputB, nearestOutput) query per -a. in batch mode (more than one
+  # -a) each query's outputs are named as given but written to their own directory in batchDir.
+  queries = [(inputsA[0], output, outputA, outputB, nearestOutput)]
+  if len(inputsA) > 1:
+    queries = getBatchQueries(inputsA, batchDir, output, outputA, outputB, nearestOutput)
   print('Getting overlap between BED files @ time: ' + str(datetime.datetime.now()))
-  stdchrA = discardNonStdChrom(inputA)
-  stdchrB = discardNonStdChrom(inputB)
-  normalA = normalizeToBed6(stdchrA)
-  normalB = normalizeToBed6(stdchrB)
-  sortedA = sortBed(normalA)
-  sortedB = sortBed(normalB)
-  getOverlapping(sortedA, sortedB, outputA)
-  getOverlapping(sortedB, sortedA, outputB)
-  getOverlap(sortedA, sortedB, output)
-  if not keep:
+  #normalise and sort all inputs concurrently, then run the (independent) intersections
+  # concurrently as soon as the sorted files they need exist.
+  steps = {}
+  #input path -> SHA-256, recorded in the overlap summaries
+  fileHashes = {}
+  if cacheDir:
+    downloader.createPathToFile(safePath(cacheDir) + '/')
+    getSorted = lambda path, expandBlocks=True: \
+        getCachedSortedPath(path, cacheDir, expandBlocks, fileHashes)
+  else:
+    getSorted = getSortedPath
+  #in --transcripts mode A keeps its BED-12 blocks for the native engine to read
+  expandA = not transcripts
+  #an indexed B is already sorted, and only the part of it near A is read, once A is sorted
+  indexedB = bgzftools.isIndexed(inputB)
+  sortedB = getRegionsPath(inputB) if indexedB else getSorted(inputB)
+  sortedAs = [getSorted(query[0], expandA) for query in queries]
+  sortDeps = {}
+  toSort = [(f'sortA{i}', query[0], sortedA, expandA)
+      for (i, (query, sortedA)) in enumerate(zip(queries, sortedAs))]
+  if not indexedB:
+    toSort.insert(0, ('sortB', inputB, sortedB, True))
+  for (name, bedPath, sortedPath, expandBlocks) in toSort:
+    if cacheDir and os.path.isfile(sortedPath):
+      print(f'Reusing cached normalised, sorted {bedPath}: {sortedPath}')
+      sortDeps[sortedPath] = ()
+    elif sortedPath in sortDeps:
+      #the same file given twice only needs sorting once
+      continue
+    else:
+      steps[name] = ((), normalizeAndSortBed,
+          (bedPath, sorter, sortMemory, sortedPath, expandBlocks))
+      sortDeps[sortedPath] = (name,)
+  if indexedB:
+    #nearest features may lie up to maxDistance outside A
+    steps['regionsB'] = (tuple(steps), extractIndexedRegions,
+        (sorted(set(sortedAs)), inputB, sortedB, max(maxDistance, 0)))
+    sortDeps[sortedB] = ('regionsB',)
+  options = {
+    'maxDistance': maxDistance,
+    'minFractionA': minFractionA,
+    'minFractionB': minFractionB,
+    'metrics': metrics,
+    'strandMode': strandMode,
+    'blocks': transcripts,
+  }
+  #with workers > 1 the per-chromosome pool below replaces the intersect steps, except for a native
+  # batch which reads B once for all queries instead.
+  indexedBatch = engine == 'native' and len(queries) > 1
+  if indexedBatch:
+    deps = tuple(set(dep for sortedPath in sortDeps for dep in sortDeps[sortedPath]))
+    steps['overlap'] = (deps, overlaptools.intersectBatch,
+        ([(sortedA,) + query[1:] for (query, sortedA) in zip(queries, sortedAs)], sortedB), options)
+  elif workers <= 1:
+    for (i, ((inputA, output, outputA, outputB, nearestOutput), sortedA)) in \
+        enumerate(zip(queries, sortedAs)):
+      deps = sortDeps[sortedA] + sortDeps[sortedB]
+      if engine == 'native':
+        steps[f'overlap{i}'] = (deps, overlaptools.intersectSortedFiles,
+            (sortedA, sortedB, output, outputA, outputB, nearestOutput), options)
+        continue
+      steps[f'overlappingA{i}'] = (deps, getOverlapping,
+          (sortedA, sortedB, outputA, getBedtoolsFlags(options)))
+      steps[f'overlappingB{i}'] = (deps, getOverlapping,
+          (sortedB, sortedA, outputB, getBedtoolsFlags(options, swap=True)))
+      steps[f'overlap{i}'] = (deps, getOverlap, (sortedA, sortedB, output, getBedtoolsFlags(options)))
+      if nearestOutput:
+        #bedtools has no equivalent of the nearest index search, so it always runs natively
+        steps[f'nearest{i}'] = (deps, overlaptools.intersectSortedFiles,
+            (sortedA, sortedB, None, None, None, nearestOutput), options)
+  results = runSteps(steps, stepWorkers)
+  #what the native engine wrote for each query, counted as it was written. None where bedtools wrote
+  # the outputs, which the summary then reads back instead.
+  queryCounts = [None] * len(queries)
+  if indexedBatch:
+    queryCounts = results['overlap']
+  elif workers > 1:
+    queryCounts = [getOverlapParallel(engine, sortedA, sortedB, output, outputA, outputB, workers,
+        nearestOutput, options)
+        for ((inputA, output, outputA, outputB, nearestOutput), sortedA) in zip(queries, sortedAs)]
+  elif engine == 'native':
+    queryCounts = [results[f'overlap{i}'] for i in range(len(queries))]
+  #sidecar summaries of the outputs for the later pipeline steps, see overlaptools.writeOverlapSummary
+  for ((inputA, output, outputA, outputB, nearestOutput), counts) in zip(queries, queryCounts):
+    overlaptools.writeOverlapSummary(overlaptools.getSummaryPath(output), inputA, inputB,
+        output, outputA, outputB, nearestOutput, fileHashes, options, counts)
+  if not keep and (indexedB or not cacheDir):
     print('Cleaning up intermediary files ...')
-    toDelete = [
-      stdchrA,
-      stdchrB,
-      normalA,
-      normalB,
-      sortedA,
-      sortedB,
-    ]
+    #the regions of an indexed B depend on A so are never cached
+    toDelete = {sortedB} if cacheDir else set(sortedAs + [sortedB])
     for path in toDelete:
       print(f'Deleting {path} ...')
       f = pathlib.Path(safePath(path))
@@ -10,57 +10,88 @@
 # to - strand.
 
 
+import collections
+import concurrent.futures
 import csv
 import datetime
 import getopt
+import itertools
+import json
+import multiprocessing
 import operator
 import os
 import re
+import shutil
 import sys
+import traceback
 
 #local
 import arraytools
 import beans
+import bgzftools
 import downloader
+import probetools
+import sorttools
 import ziptools
 import constants as c
 import get_ensembl_funcgen_organisms as org
+import org_array_gpl
 
 
-#downloads the funcgen database dump files (flat text) for the specified organism from ensembl.
-#@return a map of file type to location
-def getFuncgenFiles(orgString, destDir, fileTypes, cleanUp):
+#the big tables, which are started downloading first so the small ones finish (and get parsed)
+# while these are still coming down.
+LARGE_FUNCGEN_TABLES = ['probe_feature', 'probe']
+#lookup tables for the worker processes of createBedFileParallel. set before the workers are forked
+# so they're inherited (copy on write) rather than pickled to each worker.
+workerTables = {}
+#createBedFile records how far it got in <output file><CHECKPOINT_SUFFIX>, for --resume
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+
+#downloads the funcgen database dump files (gzipped flat text) for the specified organism from ensembl
+# concurrently, in a pool of at most workers threads. yields (file type, location) as each file finishes
+# so the caller can start parsing the small tables while the large ones are still downloading.
+# interrupted downloads are resumed, and each file is verified against ensembl's CHECKSUMS.
+# the files are kept gzipped and read through ziptools.openText (or pandas) as they are parsed.
+def iterFuncgenDownloads(orgString, destDir, fileTypes, workers=4):
   downloader.createPathToFile(destDir)
   # Note: to use current Ensembl release would need to rework for changes to database schema
   # https://useast.ensembl.org/info/docs/api/core/core_schema.html
   # https://useast.ensembl.org/info/docs/api/funcgen/funcgen_schema.html
   #baseUrl = 'ftp://ftp.ensembl.org/pub/current/mysql'
   baseUrl = f'ftp://ftp.ensembl.org/pub/release-{c.PROBE_ENSEMBL_VERSION}/mysql'
-  fileNameToLocation = {}
   funcgenUrlString = orgString
   #coreUrlString = orgString.replace('funcgen', 'core')
-  for f in fileTypes:
-    print('get funcgen files - downloading %s ...' % f)
-    #schemaString = coreUrlString if f in ['coord_system', 'seq_region'] else funcgenUrlString
-    schemaString = funcgenUrlString
-    url = baseUrl + '/' + schemaString + '/' + f + '.txt.gz'
-    if not destDir.endswith('/'):
-      destDir += '/'
-    output = destDir + f + '.txt'
-    zippedOutput = output + '.gz'
-    downloader.simpleDownload(url, zippedOutput)
-    ziptools.gunzip(zippedOutput, output)
-    fileNameToLocation[f] = output
-    if cleanUp:
-      os.remove(zippedOutput)
-  return fileNameToLocation
+  if not destDir.endswith('/'):
+    destDir += '/'
+  #every ensembl mysql directory has a CHECKSUMS file to verify the downloads against
+  checksums = downloader.getChecksums(baseUrl + '/' + funcgenUrlString + '/CHECKSUMS') or {}
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+    futures = {}
+    for f in sorted(fileTypes, key=lambda f: f not in LARGE_FUNCGEN_TABLES):
+      print('get funcgen files - downloading %s ...' % f)
+      #schemaString = coreUrlString if f in ['coord_system', 'seq_region'] else funcgenUrlString
+      schemaString = funcgenUrlString
+      url = baseUrl + '/' + schemaString + '/' + f + '.txt.gz'
+      zippedOutput = destDir + f + '.txt.gz'
+      futures[executor.submit(downloader.verifiedDownload, url, zippedOutput,
+          checksums.get(f + '.txt.gz'))] = (f, zippedOutput)
+    for future in concurrent.futures.as_completed(futures):
+      #re-raises any download error
+      future.result()
+      f, zippedOutput = futures[future]
+      print('get funcgen files - downloaded %s @ %s' % (f, datetime.datetime.now()))
+      yield f, zippedOutput
 
-#convenience function for later retrieving data in these files
+#convenience function for later retrieving data in these files. prefers the gzipped files as
+# downloaded, falling back to unzipped ones (e.g. from older runs or rolled by hand).
 def getFuncgenFilenames(destDir):
   fileNameToLocation = {}
   fileTypes = c.GET_ENSEMBL_PROBES_DEFAULTS['fileTypes']
   for f in fileTypes:
     output = destDir + '/' + f + '.txt'
+    if os.path.isfile(output + '.gz') or not os.path.isfile(output):
+      output += '.gz'
     fileNameToLocation[f] = output
   return fileNameToLocation
 
@@ -74,7 +105,7 @@ def getCoordSystemId(coordSystemFile, schemaBuild, forceCurrentSchema):
   isCurrentCol = 8
   delim = '\t'
   #note that version can be null therefore need to split on only single tab
-  with open(coordSystemFile, 'r') as csf:
+  with ziptools.openText(coordSystemFile) as csf:
     reader = csv.reader(csf, delimiter=delim)
     for cols in reader:
       coordSystemId = cols[coordSystemIdCol]
@@ -94,7 +125,9 @@ def getCoordSystemId(coordSystemFile, schemaBuild, forceCurrentSchema):
 #@return a set of array chip ids that are expression arrays.
 #array chip ids needed not array ids, because array chip ids are used in the probe table.
 #keys of set are integer ids, values are the human readable array name.
-def getExpressionArrays(arrayFile, arrayChipFile):
+#if arrayNames is given only those expression arrays are kept, so probes and probe features on
+# other arrays are dropped as the tables are read.
+def getExpressionArrays(arrayFile, arrayChipFile, arrayNames=None):
   arrayIdToChipId = {}
   expressionArrayChipIds = {}
   delim = '\t'
@@ -103,17 +136,19 @@ def getExpressionArrays(arrayFile, arrayChipFile):
   #array_chip.txt file:
   arrayChipFileFormat = {'arrayChipIdCol': 0, 'arrayIdCol': 2}
   #build map of array_id to array_chip_id
-  with open(arrayChipFile, 'r') as acf:
+  with ziptools.openText(arrayChipFile) as acf:
     arrayChipReader = csv.reader(acf, delimiter=delim)
     for arrayChipCols in arrayChipReader:
       arrayChipId = arrayChipCols[arrayChipFileFormat['arrayChipIdCol']]
       arrayId = arrayChipCols[arrayChipFileFormat['arrayIdCol']]
       arrayIdToChipId[arrayId] = arrayChipId
   #get the array chip id for each array that is format "EXPRESSION"
-  with open(arrayFile, 'r') as af:
+  with ziptools.openText(arrayFile) as af:
     arrayReader = csv.reader(af, delimiter=delim)
     for arrayCols in arrayReader:
       if arrayCols[arrayFileFormat['formatCol']] == 'EXPRESSION':
+        if arrayNames is not None and arrayCols[arrayFileFormat['arrayName']] not in arrayNames:
+          continue
         arrayId = arrayCols[arrayFileFormat['arrayIdCol']]
         if arrayId in list(arrayIdToChipId.keys()):
           arrayChipId = arrayIdToChipId[arrayId]
@@ -124,12 +159,40 @@ def getExpressionArrays(arrayFile, arrayChipFile):
               + arrayId, file=sys.stderr)
   return expressionArrayChipIds
 
+#resolves the --arrays option to the set of array names to keep, or None to keep all expression
+# arrays: 'curated' for the arrays with a GPL curated in org_array_gpl.py for the organism, a file
+# with one array name per line, or a comma separated list of array names.
+def getArrayFilter(arrays, organism):
+  if not arrays:
+    return None
+  if arrays == 'curated':
+    return org_array_gpl.getCuratedArrays(organism)
+  if os.path.isfile(arrays):
+    with open(arrays, 'r') as f:
+      return set(line.strip() for line in f if line.strip())
+  return set(a.strip() for a in arrays.split(',') if a.strip())
+
+#reads the probe set file into a map of probe set id to probe set name.
+def getProbeSets(probeSetFile, chunksize=100):
+  delim = '\t'
+  probeSets = {}  #id to name
+  probeSetProbeSetIdCol = 0
+  probeSetProbeSetNameCol = 1
+  print('get probes - probeset file @ %s' % datetime.datetime.now())
+  with ziptools.openText(probeSetFile) as psf:
+    probeSetReader = csv.reader(psf, delimiter=delim)
+    for chunk in arraytools.getChunks(probeSetReader, chunksize=chunksize):
+      for psr in chunk:
+        probeSets[psr[probeSetProbeSetIdCol]] = psr[probeSetProbeSetNameCol]
+  return probeSets
+
 #need to use probe file in order to get the name of probes, 
 # whether they are in a probe set,
 # and whether they are expression probes (via the array chip id).
+#the probe set map can be passed in if it's already been read with getProbeSets.
 #@return a map of expression probes
 def getExpressionProbes(probeFile, probeSetFile, expressionArrayChipIds,
-      chunksize=100, keysOnly=False):
+      chunksize=100, keysOnly=False, probeSets=None):
   print('Start get probes @ %s' % datetime.datetime.now())
   delim = '\t'
   nullChar = '\\N'  #i.e. '\N' is null in the probe file
@@ -138,17 +201,10 @@ def getExpressionProbes(probeFile, probeSetFile, expressionArrayChipIds,
   probeSetIdCol = 1  #nullable
   nameCol = 2
   arrayChipIdCol = 4
-  probeSets = {}  #id to name
-  probeSetProbeSetIdCol = 0
-  probeSetProbeSetNameCol = 1
-  print('get probes - probeset file @ %s' % datetime.datetime.now())
-  with open(probeSetFile, 'r') as psf:
-    probeSetReader = csv.reader(psf, delimiter=delim)
-    for chunk in arraytools.getChunks(probeSetReader, chunksize=chunksize):
-      for psr in chunk:
-        probeSets[psr[probeSetProbeSetIdCol]] = psr[probeSetProbeSetNameCol]
+  if probeSets is None:
+    probeSets = getProbeSets(probeSetFile, chunksize)
   print('get probes - probe file @ %s' % datetime.datetime.now())
-  with open(probeFile, 'r') as pf:
+  with ziptools.openText(probeFile) as pf:
     probeReader = csv.reader(pf, delimiter=delim)
     for chunk in arraytools.getChunks(probeReader, chunksize=chunksize):
       for pr in chunk:
@@ -169,30 +225,153 @@ def getExpressionProbes(probeFile, probeSetFile, expressionArrayChipIds,
           expressionProbes[probeId] = probe
   return expressionProbes
 
+#same as getExpressionProbes but builds a compact probetools.ProbeTable keyed by integer probe id
+# instead of a dict of beans.Probe, for createBedFileFromTable.
+#@return a ProbeTable of expression probes
+def getExpressionProbeTable(probeFile, probeSetFile, expressionArrayChipIds,
+      chunksize=100, probeSets=None):
+  print('Start get probes @ %s' % datetime.datetime.now())
+  delim = '\t'
+  probeIdCol = 0
+  probeSetIdCol = 1  #nullable
+  nameCol = 2
+  arrayChipIdCol = 4
+  if probeSets is None:
+    probeSets = getProbeSets(probeSetFile, chunksize)
+  print('get probes - probe file @ %s' % datetime.datetime.now())
+  with ziptools.openText(probeFile) as pf:
+    probeReader = csv.reader(pf, delimiter=delim)
+    #only keep probes corresponding to a probe expression array. null ('\N') probe set ids
+    # aren't in probeSets.
+    probeTable = probetools.ProbeTable(
+        (pr[probeIdCol], probeSets.get(pr[probeSetIdCol]), pr[nameCol], expressionArrayChipIds[pr[arrayChipIdCol]])
+        for chunk in arraytools.getChunks(probeReader, chunksize=chunksize)
+        for pr in chunk
+        if pr[arrayChipIdCol] in expressionArrayChipIds)
+  print('get probes - %s probes in lookup table @ %s' % (len(probeTable), datetime.datetime.now()))
+  return probeTable
+
+#returns the tab separated table sorted by the integer id in column col: the file itself if it
+# already is (as ensembl dumps their tables in primary key order), else a copy externally sorted with
+# sorttools to sortedOutput, in at most memory.
+def getIdSortedFile(tableFile, col, sortedOutput, memory):
+  getKey = sorttools.getIntColumnKey(col)
+  with ziptools.openText(tableFile) as f:
+    if sorttools.isSortedBy(f, getKey):
+      return tableFile
+  print('sorting %s by column %s to %s @ %s' % (tableFile, col, sortedOutput, datetime.datetime.now()))
+  with ziptools.openText(tableFile) as f:
+    #stable, so rows with the same id stay in file order
+    sorttools.sortLines(f, sortedOutput, getKey, memory, headerPrefixes=None, stable=True)
+  return sortedOutput
+
+#streams the expression probes of a probe file sorted by probe id.
+#@return generator of (integer probe id, probe description for the bed file), in probe id order.
+# as with getExpressionProbes, of several expression probes with the same id the last is used.
+def iterExpressionProbeDescs(probeFile, probeSets, expressionArrayChipIds):
+  delim = '\t'
+  nullChar = '\\N'  #i.e. '\N' is null in the probe file
+  probeIdCol = 0
+  probeSetIdCol = 1  #nullable
+  nameCol = 2
+  arrayChipIdCol = 4
+  with ziptools.openText(probeFile) as pf:
+    probeReader = csv.reader(pf, delimiter=delim)
+    for (probeId, group) in itertools.groupby(probeReader, key=lambda pr: int(pr[probeIdCol])):
+      pr = None
+      for row in group:
+        if row[arrayChipIdCol] in expressionArrayChipIds:
+          pr = row
+      if pr is None:
+        continue
+      probeSetId = pr[probeSetIdCol]
+      probeSetName = probeSets.get(probeSetId) if probeSetId != nullChar else None
+      arrayName = expressionArrayChipIds[pr[arrayChipIdCol]]
+      #for probes with a probe set name, format their id column in the BED file as
+      # array/probe_set:probe else use array/probe
+      probeDesc = '%s/%s:%s' % (arrayName, probeSetName, pr[nameCol]) \
+          if (probeSetName) \
+          else '%s/%s' % (arrayName, pr[nameCol])
+      yield (probeId, probeDesc)
+
+#same as createBedFile but as a sort-merge join of probe features against the probe file, streaming
+# both in probe id order so memory use doesn't grow with the # of probes. either file is externally
+# sorted by probe id (to tmpDir, in at most sortMemory) first if it isn't already.
+#note the output is in probe id order rather than probe feature file order.
+def createBedFileByMergeJoin(probeFeatureFile, seqRegionIdMap, probeFile, probeSets,
+    expressionArrayChipIds, outputFile, organism, chunksize, sortMemory='1G', tmpDir=None,
+    sortOutput=False):
+  delim = '\t'
+  seqRegionIdCol = 1
+  seqRegionStartCol = 2
+  seqRegionEndCol = 3
+  seqRegionStrandCol = 4
+  probeIdCol = 5
+  if not tmpDir:
+    tmpDir = os.path.dirname(os.path.abspath(outputFile))
+  print('create bed - # seq region keys: ' + str(len(seqRegionIdMap)))
+  #ensure directories to output file are created
+  print('create bed - creating path to ' + outputFile + '...')
+  downloader.createPathToFile(outputFile)
+  sortedProbeFile = getIdSortedFile(probeFile, 0,
+      os.path.join(tmpDir, 'probe.by_probe_id.txt'), sortMemory)
+  sortedProbeFeatureFile = getIdSortedFile(probeFeatureFile, probeIdCol,
+      os.path.join(tmpDir, 'probe_feature.by_probe_id.txt'), sortMemory)
+  print('create bed - using probe feature file %s' % sortedProbeFeatureFile)
+  print('create bed - start writing output...')
+  try:
+    probes = iterExpressionProbeDescs(sortedProbeFile, probeSets, expressionArrayChipIds)
+    (probeId, probeDesc) = next(probes, (None, None))
+    with openBedOutput(outputFile, sortOutput, sortMemory) as output:
+      with ziptools.openText(sortedProbeFeatureFile) as pff:
+        probeFeatureReader = csv.reader(pff, delimiter=delim)
+        for chunk in arraytools.getChunks(probeFeatureReader, chunksize):
+          for cols in chunk:
+            featureProbeId = int(cols[probeIdCol])
+            #advance through the probes to this feature's probe
+            while probeId is not None and probeId < featureProbeId:
+              (probeId, probeDesc) = next(probes, (None, None))
+            if probeId != featureProbeId:
+              #this wasn't a probe feature with a relevant probe
+              continue
+            chrom = seqRegionIdMap.get(cols[seqRegionIdCol])
+            if chrom is None:
+              continue
+            output.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (
+                chrom,
+                cols[seqRegionStartCol],
+                cols[seqRegionEndCol],
+                probeDesc,
+                0,
+                '+' if (cols[seqRegionStrandCol] == '1') else '-'
+              ))
+  finally:
+    for sortedFile in (sortedProbeFile, sortedProbeFeatureFile):
+      if sortedFile not in (probeFile, probeFeatureFile):
+        downloader.remove(sortedFile)
+  print('create bed - done writing output @ time: ' + str(datetime.datetime.now()))
+
 #@input a probe file and probeset file, and a list of valid expression arrays to filter on
-#@return pandas dataframe of expression probes
+#@return pandas dataframe of expression probes, indexed by (integer) probe id, with the same
+# last-one-wins handling of repeated probe ids as getExpressionProbes.
 #dataframe columns (not in order):
-# probeSetId, probeSetName, probeId, probeName, arrayChipId
+# probeSetName, probeName, arrayChipId, arrayChipName (categorical), probeDesc
+#probeDesc is the BED name column, array/probe_set:probe or array/probe, built column-wise
+# rather than row by row.
 def getExpressionProbeDataFrame(probeFile, probeSetFile, expressionArrayChipIds,
       keysOnly=False):
   import pandas as pd
   print('Start get probes @ %s' % datetime.datetime.now())
-  #pidgeon-hole the expressionArrayChipIds dictionary of chip id -> chip name
-  # into a dataframe object. could go back and re-write function creating the dict.
-  expressionArrayChipIdFrame = pd.DataFrame(data={
-      'arrayChipId': list(expressionArrayChipIds.keys()),
-      'arrayChipName': list(expressionArrayChipIds.values())
-  })
   #some constants regarding the files
   delim = '\t'
   nullChar = '\\N'  #i.e. '\N' is null in the probe file
   probeSetCols = [0, 1]
   probeSetColNames = ['probeSetId', 'probeSetName']
-  #data types must all be string due to presence of NA values for probesetid in probe file
-  probeSetDataTypes = {'probeSetId': str, 'probeSetName': str}
   probeCols = [0, 1, 2, 4]  #probesetid can be nullable
   probeColNames = ['probeId', 'probeSetId', 'probeName', 'arrayChipId']
-  probeDataTypes = {'probeId': str, 'probeSetId': str, 
+  #ids are compared as they're written in the files, like getExpressionProbes does. na_filter off
+  # so names like 'NA' aren't turned into nulls.
+  probeDataTypes = {'probeId': 'int64', 'probeSetId': str,
       'probeName': str, 'arrayChipId': str}
   #read in the probe set file
   print('get probes - probeset file @ %s' % datetime.datetime.now())
@@ -201,11 +380,14 @@ def getExpressionProbeDataFrame(probeFile, probeSetFile, expressionArrayChipIds,
       usecols=probeSetCols,
       sep=delim,
       header=None,
-      dtype=probeSetDataTypes,
-      low_memory=False,
+      dtype=str,
+      na_filter=False,
       engine='c',
       names=probeSetColNames
   )
+  probeSetNames = probeSetFrame.drop_duplicates('probeSetId', keep='last') \
+      .set_index('probeSetId')['probeSetName']
+  probeSetFrame = None
   #read in the probe file
   print('get probes - probe file @ %s' % datetime.datetime.now())
   probeFrame = pd.read_csv(
@@ -214,23 +396,29 @@ def getExpressionProbeDataFrame(probeFile, probeSetFile, expressionArrayChipIds,
       sep=delim,
       header=None,
       dtype=probeDataTypes,
-      na_values=[nullChar],
-      low_memory=False,
+      na_filter=False,
       engine='c',
       names=probeColNames
   )
-  print('get probes - merging @ %s' % datetime.datetime.now())
-  #merge the probeset file probesetname into the probe file info.
-  # probesetid can be null therefore left join.
-  mergedOnProbeSetIdFrame = pd.merge(probeFrame, probeSetFrame, on='probeSetId', how='left')
-  #now, merged frame cols (not in order):
-  # probeid, probesetid, probesetname, probename, arraychipid
-  #filter resulting dataframe for only probes that are in expression arrays we want
-  # i.e. arraychipid in expressionArrayChipIds.
-  # must have valid arraychipid therefore inner join.
-  filteredOnArrayFrame = pd.merge(mergedOnProbeSetIdFrame, expressionArrayChipIdFrame, 
-      on='arrayChipId', how='inner')
-  return filteredOnArrayFrame
+  #filter for only probes that are in expression arrays we want, i.e. arraychipid in
+  # expressionArrayChipIds. a later row for the same probe id replaces an earlier one.
+  print('get probes - filtering @ %s' % datetime.datetime.now())
+  probeFrame = probeFrame[probeFrame['arrayChipId'].isin(expressionArrayChipIds)]
+  probeFrame = probeFrame.drop_duplicates('probeId', keep='last').set_index('probeId')
+  probeFrame['arrayChipName'] = probeFrame['arrayChipId'].map(expressionArrayChipIds).astype('category')
+  if keysOnly:
+    return probeFrame[[]]
+  #look up the probe set names. probesetid can be null
+  probeSetIds = probeFrame['probeSetId'].where(~probeFrame['probeSetId'].isin([nullChar, '']))
+  probeFrame['probeSetName'] = probeSetIds.map(probeSetNames).fillna('')
+  probeFrame = probeFrame.drop(columns='probeSetId')
+  #for probes with a probe set name, format their id column in the BED file as
+  # array/probe_set:probe else use array/probe
+  print('get probes - creating probe description column @ %s' % datetime.datetime.now())
+  probeSetPart = (probeFrame['probeSetName'] + ':').where(probeFrame['probeSetName'] != '', '')
+  probeFrame['probeDesc'] = probeFrame['arrayChipName'].astype(str) + '/' + probeSetPart \
+      + probeFrame['probeName']
+  return probeFrame
 
 #takes an organism string like homo_sapiens_funcgen_84_38 and returns 84_38
 def getSchemaBuildFromOrganism(organism):
@@ -253,7 +441,7 @@ def getSequenceRegionIds(seqRegionFile, coordSystemId, schemaBuild):
   coordSystemIdCol = 2
   schemaBuildCol = 4
   delim = '\t'
-  with open(seqRegionFile, 'r') as f:
+  with ziptools.openText(seqRegionFile) as f:
     reader = csv.reader(f, delimiter=delim)
     for cols in reader:
       seqRegionId = cols[seqRegionIdCol]
@@ -270,13 +458,43 @@ def getSequenceRegionIds(seqRegionFile, coordSystemId, schemaBuild):
         seqRegionIdMap[seqRegionId] = 'chr%s' % name
   return seqRegionIdMap
 
-#creates bed file out of probe features.
-#formats the output as a BED-6 file: chrom, chromStart, chromEnd, name, score (0), strand. note
-# here that name = (internal database) probe id.
-#organism just for bed file header line (not implemented atm).
-def createBedFile(probeFeatureFile, seqRegionIdMap, expressionProbes, 
-    outputFile, organism, chunksize):
-  delim = '\t'
+#parses whichever of the small dimension tables can be parsed with the funcgen files available so
+# far, storing the results in tables (keys: coordSystemId, seqRegionIdMap, expressionArrayChipIds,
+# probeSets). called as each download finishes so these are ready by the time probe and
+# probe_feature arrive.
+def parseDimensionTables(funcgenFiles, tables, schemaBuild, forceCurrentSchema, chunksize,
+    probeSets=True, arrayNames=None):
+  if 'coordSystemId' not in tables and 'coord_system' in funcgenFiles:
+    #get current coordinate system id corresponding to chromosomes
+    print('Start coord system time: ' + str(datetime.datetime.now()))
+    tables['coordSystemId'] = getCoordSystemId(funcgenFiles['coord_system'], schemaBuild, forceCurrentSchema)
+    print('Coordinate system id: %s' % tables['coordSystemId'])
+  if 'seqRegionIdMap' not in tables and 'coordSystemId' in tables and 'seq_region' in funcgenFiles:
+    #get all sequence region ids for those chromosomes. note # ids = # chromosomes in the organism.
+    print('Start sequence regions time: ' + str(datetime.datetime.now()))
+    tables['seqRegionIdMap'] = getSequenceRegionIds(funcgenFiles['seq_region'],
+        tables['coordSystemId'], schemaBuild)
+    print('Number of sequence region ids: %s' % len(tables['seqRegionIdMap']))
+  if 'expressionArrayChipIds' not in tables and 'array' in funcgenFiles and 'array_chip' in funcgenFiles:
+    #get array and probe data to be able to filter out the non-expression array probe features
+    print('Start expression arrays time: ' + str(datetime.datetime.now()))
+    tables['expressionArrayChipIds'] = getExpressionArrays(funcgenFiles['array'], funcgenFiles['array_chip'],
+        arrayNames)
+    print('Number of expression arrays: %s' % len(tables['expressionArrayChipIds']))
+  if probeSets and 'probeSets' not in tables and 'probe_set' in funcgenFiles:
+    tables['probeSets'] = getProbeSets(funcgenFiles['probe_set'], chunksize)
+
+#opens the BED output file for writing: directly, or if sortOutput through a
+# sorttools.BucketedBedWriter which writes it sorted by chromosome and start position (in at most
+# sortMemory), marked as such for find_overlap.py.
+def openBedOutput(outputFile, sortOutput=False, sortMemory='1G'):
+  if sortOutput:
+    return sorttools.BucketedBedWriter(outputFile, sortMemory)
+  return open(outputFile, 'w')
+
+#formats the probe feature rows (split columns) of relevant probes as BED lines, skipping the rest.
+#@return generator of BED-6 lines
+def iterBedLines(rows, seqRegionIdMap, expressionProbes):
   #probeFeatureIdCol = 0
   seqRegionIdCol = 1
   seqRegionStartCol = 2
@@ -286,6 +504,71 @@ def createBedFile(probeFeatureFile, seqRegionIdMap, expressionProbes,
   #analysisIdCol = 6
   #mismatchesCol = 7
   #cigarLineCol = 8
+  for cols in rows:
+    try:
+      #this will fail with KeyError if the probe feature doesn't correspond to a probe
+      # we are interested in
+      probe = expressionProbes[cols[probeIdCol]]
+      #convert the requence region id to chromosome
+      chrom = seqRegionIdMap[cols[seqRegionIdCol]]
+      #NOTE in Ensembl flat files mitochondrial is denoted as chrMT.
+      # we convert this to chrM before outputting to BED file.
+      if chrom == 'MT':
+        chrom = 'M'
+      #for probes with a probe set name, format their id column in the BED file as 
+      # array/probe_set:probe else use array/probe
+      probeDesc = '%s/%s:%s' % (probe.arrayName, probe.probeSetName, probe.name) \
+          if (probe.probeSetName) \
+          else '%s/%s' % (probe.arrayName, probe.name)
+      yield '%s\t%s\t%s\t%s\t%s\t%s\n' % (
+          chrom,
+          cols[seqRegionStartCol],
+          cols[seqRegionEndCol],
+          probeDesc,
+          0,
+          '+' if (cols[seqRegionStrandCol] == '1') else '-'
+        )
+    except KeyError:
+      #this wasn't a probe feature with a relevant probe
+      continue
+
+#reads the checkpoint left by an interrupted createBedFile run writing outputFile from probeFeatureFile.
+#@return (probe feature file offset, output file offset), or None if there's no checkpoint, or it's
+# for another probe feature file, or the output is shorter than the checkpoint says
+def readCheckpoint(outputFile, probeFeatureFile):
+  try:
+    with open(outputFile + CHECKPOINT_SUFFIX, 'r') as checkpointFile:
+      checkpoint = json.load(checkpointFile)
+  except (OSError, ValueError):
+    return None
+  if checkpoint.get('probeFeatureFile') != os.path.abspath(probeFeatureFile) or \
+      checkpoint.get('probeFeatureSize') != os.path.getsize(probeFeatureFile):
+    print('create bed - checkpoint is for another probe feature file, ignoring it', file=sys.stderr)
+    return None
+  if not os.path.isfile(outputFile) or os.path.getsize(outputFile) < checkpoint['outputOffset']:
+    print('create bed - %s is shorter than its checkpoint, ignoring it' % outputFile, file=sys.stderr)
+    return None
+  return checkpoint['inputOffset'], checkpoint['outputOffset']
+
+#records that the first outputOffset bytes of outputFile are the bed lines of the first inputOffset
+# (uncompressed) bytes of probeFeatureFile. replaced atomically so a crash leaves the old or new one.
+def writeCheckpoint(outputFile, probeFeatureFile, inputOffset, outputOffset):
+  checkpointFile = outputFile + CHECKPOINT_SUFFIX
+  with open(checkpointFile + '.tmp', 'w') as f:
+    json.dump({'probeFeatureFile': os.path.abspath(probeFeatureFile),
+        'probeFeatureSize': os.path.getsize(probeFeatureFile),
+        'inputOffset': inputOffset, 'outputOffset': outputOffset}, f)
+  os.replace(checkpointFile + '.tmp', checkpointFile)
+
+#creates bed file out of probe features.
+#formats the output as a BED-6 file: chrom, chromStart, chromEnd, name, score (0), strand. note
+# here that name = (internal database) probe id.
+#organism just for bed file header line (not implemented atm).
+#unsorted output is flushed and checkpointed after each chunk. with resume, a run interrupted
+# after a checkpoint truncates the output back to it and carries on from there in the probe features.
+def createBedFile(probeFeatureFile, seqRegionIdMap, expressionProbes, 
+    outputFile, organism, chunksize, sortOutput=False, sortMemory='1G', resume=False):
+  delim = '\t'
   #PROBE_SET_NAME = 0
   #PROBE_NAME = 1
   #ARRAY_CHIP_ID = 2
@@ -295,78 +578,242 @@ def createBedFile(probeFeatureFile, seqRegionIdMap, expressionProbes,
   #ensure directories to output file are created
   print('create bed - creating path to ' + outputFile + '...')
   downloader.createPathToFile(outputFile)
-  #delete file at output if already present. open(f, 'w') should erase it for us but it's 
-  # appending for some strange reason.
-  print('create bed - removing ' + outputFile + ' if present...')
-  downloader.remove(outputFile)
+  checkpoint = None
+  if resume and sortOutput:
+    #the sorted output is only written out at the end, so there's nothing to resume
+    print('create bed - can\'t resume sorted output, starting over', file=sys.stderr)
+  elif resume:
+    checkpoint = readCheckpoint(outputFile, probeFeatureFile)
+  inputOffset = 0
+  if checkpoint:
+    inputOffset, outputOffset = checkpoint
+    print('create bed - resuming at byte %s of %s and byte %s of %s...' % (
+        inputOffset, probeFeatureFile, outputOffset, outputFile))
+    with open(outputFile, 'r+b') as output:
+      output.truncate(outputOffset)
+    output = open(outputFile, 'a')
+  else:
+    #delete file at output if already present. open(f, 'w') should erase it for us but it's 
+    # appending for some strange reason.
+    print('create bed - removing ' + outputFile + ' if present...')
+    downloader.remove(outputFile)
+    downloader.remove(outputFile + CHECKPOINT_SUFFIX)
+    output = openBedOutput(outputFile, sortOutput, sortMemory)
   #output: chrom, chromStart, chromEnd, name, score (0), strand.
   print('create bed - using probe feature file %s' % probeFeatureFile)
   print('create bed - start writing output...')
-  with open(outputFile, 'w') as output:
+  with output:
     #header = 'track name=probeFeatures ' + \
     #    'description="Ensembl microarray probe features from database ' + \
     #    organism + '" useScore=0\n'
-    with open(probeFeatureFile, 'r') as pff:
-      probeFeatureReader = csv.reader(pff, delimiter=delim)
+    #read as bytes to keep track of the offset into the probe features
+    with ziptools.openBinary(probeFeatureFile) as pff:
+      pff.seek(inputOffset)
         #TODO add header back in and later logic dealing with it
       #output.write(header)
+      for chunk in arraytools.getChunks(pff, chunksize):
+        probeFeatureReader = csv.reader((line.decode() for line in chunk), delimiter=delim)
+        output.writelines(iterBedLines(probeFeatureReader, seqRegionIdMap, expressionProbes))
+        inputOffset += sum(len(line) for line in chunk)
+        if not sortOutput:
+          output.flush()
+          writeCheckpoint(outputFile, probeFeatureFile, inputOffset, output.tell())
+  downloader.remove(outputFile + CHECKPOINT_SUFFIX)
+  print('create bed - done writing output @ time: ' + str(datetime.datetime.now()))
+
+#returns line aligned (start, end) byte ranges splitting the file into at most parts pieces
+def getLineRanges(path, parts):
+  size = os.path.getsize(path)
+  offsets = [0]
+  with open(path, 'rb') as f:
+    for i in range(1, parts):
+      pos = size * i // parts
+      if pos <= offsets[-1]:
+        continue
+      #move to the start of the line after the one containing pos - 1
+      f.seek(pos - 1)
+      f.readline()
+      if offsets[-1] < f.tell() < size:
+        offsets.append(f.tell())
+  offsets.append(size)
+  return list(zip(offsets[:-1], offsets[1:]))
+
+#worker for createBedFileParallel: writes the BED lines for the probe features in the byte range
+# [start, end) of an uncompressed probe feature file to fragmentFile
+def createBedFragment(probeFeatureFile, start, end, fragmentFile, chunksize):
+  def iterRangeLines(f):
+    pos = start
+    while pos < end:
+      line = f.readline()
+      if not line:
+        break
+      pos += len(line)
+      yield line.decode()
+  with open(probeFeatureFile, 'rb') as f, open(fragmentFile, 'w') as output:
+    f.seek(start)
+    probeFeatureReader = csv.reader(iterRangeLines(f), delimiter='\t')
+    for chunk in arraytools.getChunks(probeFeatureReader, chunksize):
+      output.writelines(iterBedLines(chunk, workerTables['seqRegionIdMap'], workerTables['expressionProbes']))
+  return fragmentFile
+
+#worker for createBedFileParallel: returns the BED lines for a batch of probe feature file lines
+def getBedText(lines):
+  return ''.join(iterBedLines(csv.reader(lines, delimiter='\t'),
+      workerTables['seqRegionIdMap'], workerTables['expressionProbes']))
+
+#collapses the probe features of a sorted BED file (see sorttools.BucketedBedWriter) to probe set level:
+# the features of each probe set are merged into the intervals they cover, per chromosome and strand,
+# named array/probe_set. probes not in a probe set (array/probe) are merged the same way by probe name.
+# the output is sorted the same way as the input and can be the same file.
+def collapseProbeSets(bedFile, outputFile):
+  print('collapse probe sets - %s to %s @ %s' % (bedFile, outputFile, datetime.datetime.now()))
+  numFeatures = 0
+  numIntervals = 0
+  tmp = outputFile + '.tmp'
+  def getChromLines(chrom, openIntervals, intervals):
+    intervals.extend((start, end, name, strand) for ((name, strand), (start, end)) in openIntervals.items())
+    lines = ['%s\t%s\t%s\t%s\t0\t%s\n' % (chrom, start, end, name, strand)
+        for (start, end, name, strand) in intervals]
+    #same order as sorttools: start, then the whole line
+    return [line for (start, line) in sorted(zip((i[0] for i in intervals), lines))]
+  with open(bedFile, 'r') as bed, open(tmp, 'w') as output:
+    output.write(sorttools.SORTED_MARKER)
+    chrom = None
+    #(probe set name, strand) -> [start, end] of the interval being extended
+    openIntervals = {}
+    #finished intervals on the current chromosome
+    intervals = []
+    for line in bed:
+      if not line.strip() or line.startswith(sorttools.HEADER_PREFIXES):
+        continue
+      cols = line.rstrip('\r\n').split('\t')
+      start = int(cols[1])
+      end = int(cols[2])
+      if cols[0] != chrom:
+        if chrom is not None:
+          lines = getChromLines(chrom, openIntervals, intervals)
+          output.writelines(lines)
+          numIntervals += len(lines)
+        chrom = cols[0]
+        openIntervals = {}
+        intervals = []
+      key = (cols[3].split(':', 1)[0], cols[5])
+      interval = openIntervals.get(key)
+      if interval is not None and start <= interval[1]:
+        interval[1] = max(interval[1], end)
+      else:
+        if interval is not None:
+          intervals.append((interval[0], interval[1]) + key)
+        openIntervals[key] = [start, end]
+      numFeatures += 1
+    if chrom is not None:
+      lines = getChromLines(chrom, openIntervals, intervals)
+      output.writelines(lines)
+      numIntervals += len(lines)
+  os.replace(tmp, outputFile)
+  print('collapse probe sets - %s probe features to %s intervals @ %s' % (numFeatures, numIntervals,
+      datetime.datetime.now()))
+
+#same as createBedFile but split over workers processes, which share the lookup tables by being
+# forked after they're built. an uncompressed probe feature file is split into line aligned byte
+# ranges, one per worker, whose BED fragments are concatenated in order. a gzipped one can't be
+# seeked into so it's read here and handed out in batches of chunksize lines, with the results
+# written in order. either way the output is the same as createBedFile's.
+#falls back to createBedFile with one worker or where processes can't be forked.
+def createBedFileParallel(probeFeatureFile, seqRegionIdMap, expressionProbes,
+    outputFile, organism, chunksize, workers, sortOutput=False, sortMemory='1G', resume=False):
+  if resume and workers > 1:
+    #checkpoints are only kept by createBedFile, reading the probe features in order
+    print('create bed - resuming with a single worker')
+  if workers <= 1 or resume or 'fork' not in multiprocessing.get_all_start_methods():
+    return createBedFile(probeFeatureFile, seqRegionIdMap, expressionProbes,
+        outputFile, organism, chunksize, sortOutput, sortMemory, resume)
+  print('create bed - # seq region keys: ' + str(len(seqRegionIdMap)))
+  print('create bed - # expression probes: ' + str(len(expressionProbes)))
+  print('create bed - creating path to ' + outputFile + '...')
+  downloader.createPathToFile(outputFile)
+  print('create bed - using probe feature file %s with %s workers' % (probeFeatureFile, workers))
+  print('create bed - start writing output...')
+  workerTables['seqRegionIdMap'] = seqRegionIdMap
+  workerTables['expressionProbes'] = expressionProbes
+  fragments = []
+  try:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+        mp_context=multiprocessing.get_context('fork')) as executor:
+      if probeFeatureFile.endswith('.gz'):
+        with ziptools.openText(probeFeatureFile) as pff, \
+            openBedOutput(outputFile, sortOutput, sortMemory) as output:
+          #keep a couple of batches per worker in flight, bounding memory
+          pending = collections.deque()
+          for chunk in arraytools.getChunks(pff, chunksize):
+            pending.append(executor.submit(getBedText, chunk))
+            if len(pending) >= 2 * workers:
+              output.write(pending.popleft().result())
+          while pending:
+            output.write(pending.popleft().result())
+      else:
+        ranges = getLineRanges(probeFeatureFile, workers)
+        fragments = ['%s.part%s' % (outputFile, i) for i in range(len(ranges))]
+        futures = [executor.submit(createBedFragment, probeFeatureFile, start, end, fragment, chunksize)
+            for ((start, end), fragment) in zip(ranges, fragments)]
+        with openBedOutput(outputFile, sortOutput, sortMemory) as output:
+          for future in futures:
+            with open(future.result(), 'r') as fragment:
+              shutil.copyfileobj(fragment, output)
+  finally:
+    workerTables.clear()
+    for fragment in fragments:
+      downloader.remove(fragment)
+  print('create bed - done writing output @ time: ' + str(datetime.datetime.now()))
+
+#same as createBedFile but with the expression probes in a probetools.ProbeTable, which each chunk
+# of probe features is looked up in at once.
+def createBedFileFromTable(probeFeatureFile, seqRegionIdMap, probeTable, outputFile, organism, chunksize,
+    sortOutput=False, sortMemory='1G'):
+  delim = '\t'
+  seqRegionIdCol = 1
+  seqRegionStartCol = 2
+  seqRegionEndCol = 3
+  seqRegionStrandCol = 4
+  probeIdCol = 5
+  print('create bed - # seq region keys: ' + str(len(seqRegionIdMap)))
+  print('create bed - # expression probes: ' + str(len(probeTable)))
+  #ensure directories to output file are created
+  print('create bed - creating path to ' + outputFile + '...')
+  downloader.createPathToFile(outputFile)
+  print('create bed - using probe feature file %s' % probeFeatureFile)
+  print('create bed - start writing output...')
+  with openBedOutput(outputFile, sortOutput, sortMemory) as output:
+    with ziptools.openText(probeFeatureFile) as pff:
+      probeFeatureReader = csv.reader(pff, delimiter=delim)
       for chunk in arraytools.getChunks(probeFeatureReader, chunksize):
-        for cols in chunk:
-          try:
-            #this will fail with KeyError if the probe feature doesn't correspond to a probe
-            # we are interested in
-            probe = expressionProbes[cols[probeIdCol]]
-            #convert the requence region id to chromosome
-            chrom = seqRegionIdMap[cols[seqRegionIdCol]]
-            #NOTE in Ensembl flat files mitochondrial is denoted as chrMT.
-            # we convert this to chrM before outputting to BED file.
-            if chrom == 'MT':
-              chrom = 'M'
-            #for probes with a probe set name, format their id column in the BED file as 
-            # array/probe_set:probe else use array/probe
-            probeDesc = '%s/%s:%s' % (probe.arrayName, probe.probeSetName, probe.name) \
-                if (probe.probeSetName) \
-                else '%s/%s' % (probe.arrayName, probe.name)
-            line = '%s\t%s\t%s\t%s\t%s\t%s\n' % (
-                chrom,
-                cols[seqRegionStartCol],
-                cols[seqRegionEndCol],
-                probeDesc,
-                0,
-                '+' if (cols[seqRegionStrandCol] == '1') else '-'
-              )
-            output.write(line)
-          except KeyError:
-            #this wasn't a probe feature with a relevant probe
+        indices = probeTable.lookup([int(cols[probeIdCol]) for cols in chunk]).tolist()
+        for (cols, i) in zip(chunk, indices):
+          #skip probe features without a relevant probe, or not on a chromosome
+          if i < 0:
+            continue
+          chrom = seqRegionIdMap.get(cols[seqRegionIdCol])
+          if chrom is None:
             continue
+          output.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (
+              chrom,
+              cols[seqRegionStartCol],
+              cols[seqRegionEndCol],
+              probeTable.getProbeDesc(i),
+              0,
+              '+' if (cols[seqRegionStrandCol] == '1') else '-'
+            ))
   print('create bed - done writing output @ time: ' + str(datetime.datetime.now()))
 
-#@input dataframe row with probe array, probe set, probe name
-#@return probe description formatted for a bed file
-def getProbeDesc(row):
-  import numpy as np
-  #for probes with a probe set name, format their id column in the BED file as 
-  # array/probe_set:probe else use array/probe
-  if (row['probeSetName'] and row['probeSetName'] != 'NaN' and row['probeSetName'] != np.nan):
-    probeDesc = '%s/%s:%s' % (row['arrayChipName'], row['probeSetName'], row['probeName'])
-  else:
-    probeDesc = '%s/%s' % (row['arrayName'], row['probeName'])
-  return probeDesc
-
-#@input dataframe row, strand int is 0/1 strand integer
-#@return -/+ strand symbol
-def getStrandSymbol(row):
-  if (str(row['seqRegionStrand']) == '1'):
-    symbol = '+'
-  else:
-    symbol = '-'
-  return symbol
-
 #create bed file of all relevant probe features.
-# use probe feature file and previously generated sequence region id map and 
-# data frame of all relevant expression probes.
-def createBedFileFromDataFrame(probeFeatureFile, seqRegionIdMap, expressionProbeFrame, 
-    outputFile, organism):
+# use probe feature file and previously generated sequence region id map and
+# data frame of all relevant expression probes from getExpressionProbeDataFrame.
+#writes the same lines, in the same (probe feature file) order, as createBedFile.
+#the probe feature file is streamed in batches of chunksize lines, each looked up and appended to
+# the output in turn, so memory use is set by the chunk size rather than the # of probe features.
+def createBedFileFromDataFrame(probeFeatureFile, seqRegionIdMap, expressionProbeFrame,
+    outputFile, organism, chunksize=1000000, sortOutput=False, sortMemory='1G'):
+  import numpy as np
   import pandas as pd
   #some constants defining the files
   delim = '\t'
@@ -379,111 +826,268 @@ def createBedFileFromDataFrame(probeFeatureFile, seqRegionIdMap, expressionProbe
   #analysisIdCol = 6
   #mismatchesCol = 7
   #cigarLineCol = 8
-  #PROBE_SET_NAME = 0
-  #PROBE_NAME = 1
-  #ARRAY_CHIP_ID = 2
-  #ARRAY_NAME = 3
   probeFeatureCols = [1, 2, 3, 4, 5]
   probeFeatureColNames = ['seqRegionId', 'seqRegionStart', 'seqRegionEnd',
       'seqRegionStrand', 'probeId']
-  probeFeatureDataTypes = str
+  probeFeatureDataTypes = {'seqRegionId': str, 'seqRegionStart': 'int64', 'seqRegionEnd': 'int64',
+      'seqRegionStrand': str, 'probeId': 'int64'}
   print('create bed - # seq region keys: ' + str(len(seqRegionIdMap)))
   print('create bed - # expression probes: ' + str(len(expressionProbeFrame)))
   #ensure directories to output file are created
   print('create bed - creating path to ' + outputFile + '...')
   downloader.createPathToFile(outputFile)
-  #delete file at output if already present. open(f, 'w') should erase it for us but it's 
+  #delete file at output if already present. open(f, 'w') should erase it for us but it's
   # appending for some strange reason.
   print('create bed - removing ' + outputFile + ' if present...')
   downloader.remove(outputFile)
   #output: chrom, chromStart, chromEnd, name, score (0), strand.
   print('create bed - using probe feature file %s' % probeFeatureFile)
-  #read probe feature file into dataframe
-  print('create bed - get probe feature file @ %s' % datetime.datetime.now())
-  probeFeatureFrame = pd.read_csv(
+  chroms = pd.Series(seqRegionIdMap, dtype=str).astype('category')
+  probeDescs = expressionProbeFrame['probeDesc']
+  #stream the probe feature file in batches
+  print('create bed - start writing output @ %s' % datetime.datetime.now())
+  reader = pd.read_csv(
       probeFeatureFile,
       usecols=probeFeatureCols,
       sep=delim,
       header=None,
       dtype=probeFeatureDataTypes,
-      names=probeFeatureColNames
-  )
-  #pidgeon-hole the sequence region id dictionary of sequence region id -> chromosome
-  # into a dataframe object. could go back and re-write function creating the dict.
-  seqRegionIdFrame = pd.DataFrame(data={
-      'seqRegionId': list(seqRegionIdMap.keys()),
-      'seqRegionName': list(seqRegionIdMap.values())
-  })
-  #merge in the sequence region names (i.e. chromosomes) needed for chromosome column
-  withSeqRegionName = pd.merge(probeFeatureFrame, seqRegionIdFrame, on='seqRegionId', how='inner')
-  #free up memory
-  seqRegionIdFrame = None
-  probeFeatureFrame = None
-  #merge in the probe information needed to generate the probe description column.
-  #columns in expression probe frame:
-  # probeSetId, probeSetName, probeId, probeName, arrayChipId
-  withProbeInfo = pd.merge(withSeqRegionName, expressionProbeFrame, on='probeId', how='inner')
-  #free up memory
-  withSeqRegionName = None
-  #resulting dataframe columns:
-  # seqRegionId, seqRegionStart, seqRegionEnd, seqRegionStrand, probeId
-  # seqRegionName,
-  # probeSetId, probeSetName, probeName, arrayChipId, arrayChipName
-  #we want to create a dataframe with exactly the following columns:
-  # chromosome, start, end, probeDesc, '0', strand
-  #i.e.
-  # seqRegionName, seqRegionStart, seqRegionEnd,
-  # getProbeDesc(arrayChipName, probeSetName, probeName),
-  # '0',
-  # getStrandSymbol(seqRegionStrand)
-  #clone first three columns from existing data
-  bedFrame = withProbeInfo[['seqRegionName', 'seqRegionStart', 'seqRegionEnd']].copy()
-  #create column of zeroes
-  bedFrame['zeroes'] = '0'  #or instead of .copy() above use here: bedFrame.loc[:,'zeroes'] = '0'
-  #FIXME thread dies somewhere after this point??
-  #get probe description column from arrayChipName, probeSetName, and probeName
-  print('create bed - creating probe description column @ %s' % datetime.datetime.now())
-  bedFrame['probeDesc'] = withProbeInfo.apply(getProbeDesc, axis='columns')
-  #get strand symbol from stand integer column
-  print('create bed - creating strand symbol column @ %s' % datetime.datetime.now())
-  bedFrame['seqRegionStrandSymb'] = withProbeInfo.apply(getStrandSymbol, axis='columns')
-  #free up memory
-  withProbeInfo = None
-  #write out our bed data frame to file
-  print('create bed - start writing output @ %s' % datetime.datetime.now())
-  header = ['track name=probeFeatures ' + \
-      'description="Ensembl microarray probe features from database ' + \
-      organism + '" useScore=0\n']
-  columnsToWrite = ['seqRegionName', 'seqRegionStart', 'seqRegionEnd',
-      'probeDesc', 'zeroes', 'seqRegionStrandSymb']
-  #add some empty columns to write to the header. needed to fool pandas
-  # into writing an arbitrary header as it expects a string of aliases for each column.
-  for i in range(0, len(columnsToWrite)):
-    header.append('')
-  bedFrame.to_csv(
-      path_or_buf=outputFile,
-      sep=delim,
-      index=False,
-      columns=columnsToWrite,
-      header=header,
+      na_filter=False,
+      engine='c',
+      names=probeFeatureColNames,
+      chunksize=int(chunksize)
   )
+  numFeatures = 0
+  numWritten = 0
+  #no track line header, as with createBedFile
+  with reader, openBedOutput(outputFile, sortOutput, sortMemory) as output:
+    for probeFeatureFrame in reader:
+      #look up the chromosome and probe description of each feature with a map on the id columns
+      # (hash lookups, no merge copies), dropping features on other sequence regions or probes.
+      bedFrame = pd.DataFrame({
+          'seqRegionName': probeFeatureFrame['seqRegionId'].map(chroms),
+          'seqRegionStart': probeFeatureFrame['seqRegionStart'],
+          'seqRegionEnd': probeFeatureFrame['seqRegionEnd'],
+          'probeDesc': probeFeatureFrame['probeId'].map(probeDescs),
+          'zeroes': 0,
+          'seqRegionStrandSymb': pd.Categorical(
+              np.where(probeFeatureFrame['seqRegionStrand'] == '1', '+', '-'), categories=['+', '-'])
+      }).dropna(subset=['seqRegionName', 'probeDesc'])
+      bedFrame.to_csv(output, sep=delim, index=False, header=False)
+      numFeatures += len(probeFeatureFrame)
+      numWritten += len(bedFrame)
+      print('create bed - %s/%s probe features written @ %s' % (numWritten, numFeatures,
+          datetime.datetime.now()))
   print('create bed - done writing output @ time: ' + str(datetime.datetime.now()))
 
+#matches an organism like homo_sapiens or homo_sapiens_funcgen_84_38 against the funcgen organisms
+# available for download from ensembl, listed in dataDir/availableOrganisms.txt (downloaded if not
+# there yet).
+#@return the available funcgen organism, or the organism as passed if none matches
+def getAvailableOrganism(organism, dataDir):
+  #check if we already have the file
+  funcgenOrgDefaults = c.GET_ENSEMBL_FUNCGEN_ORGANISMS_DEFAULTS
+  if dataDir:
+    availableOrganismsFileName = '%s/availableOrganisms.txt' % dataDir
+  else:
+    availableOrganismsFileName = funcgenOrgDefaults['output']
+  availableOrganismsFileName = os.path.normpath(availableOrganismsFileName)
+  #array of available organisms is a dictionary like: 
+  if os.path.isfile(availableOrganismsFileName):
+    #retrieve from file
+    availableOrganisms = []
+    with open(availableOrganismsFileName, 'r') as orgFile:
+      for line in orgFile:
+        availableOrganisms.append(line.strip())
+  else:
+    #download the available organisms
+    availableOrganismsDict = org.parseFtpIndexForOrganisms(funcgenOrgDefaults['url'], availableOrganismsFileName, None, None, None)
+    #turn dict like: homo_sapiens_funcgen_84_38 -> Homo sapiens v84.38
+    # into array of keys
+    availableOrganisms = list(availableOrganismsDict.keys())
+  #match the default or user-passed organism against the up-to-date one
+  newOrganism = None
+  for availOrg in availableOrganisms:
+    if availOrg.lower().startswith(organism.lower().split('_funcgen')[0]):
+      newOrganism = availOrg
+      break
+  if newOrganism:
+    oldOrganism = organism
+    organism = newOrganism
+    print('Updated Ensembl organism %s to %s' % (oldOrganism, organism))
+  else:
+    print('No matching new Ensembl organism for %s, download from Ensembl may fail' % organism, file=sys.stderr)
+  return organism
+
+#the whole pipeline for one organism: downloads (unless options['noDownload']) and parses the funcgen
+# tables in dataDir, and writes the probe BED file to output. options has the same keys as
+# constants.GET_ENSEMBL_PROBES_DEFAULTS.
+def buildProbeBed(organism, dataDir, output, options):
+  chunksize = options['chunksize']
+  forceCurrentSchema = options['forceCurrentSchema']
+  fileTypes = options['fileTypes']
+  noDownload = options['noDownload']
+  pandasPipeline = options['pandasPipeline']
+  cleanUp = options['cleanUp']
+  sortOutput = options['sort']
+  sortMemory = options['sortMemory']
+  bgzip = options['bgzip']
+  downloadWorkers = options['downloadWorkers']
+  lookupTable = options['lookupTable']
+  join = options['join']
+  workers = options['workers']
+  arrays = options['arrays']
+  collapse = options['collapseProbeSets']
+  resume = options['resume']
+  if not dataDir.endswith('/'):
+    dataDir += '/'
+  #get schema build from organism name string
+  print('Getting schema build from organism %s ...' % organism)
+  schemaBuild = getSchemaBuildFromOrganism(organism)
+  arrayNames = getArrayFilter(arrays, organism)
+  if arrayNames is not None:
+    print('Only keeping probes on arrays: %s' % ', '.join(sorted(arrayNames)))
+  #pipeline:
+  #grab funcgen database flat files for ensembl organism.
+  #store file name to location in a map.
+  #keys are fixed: array, array_chip, coord_system, probe, probe_set, probe_feature, seq_region
+  #the small tables are parsed as soon as they're available, while the rest are still downloading.
+  tables = {}
+  if not noDownload:
+    print('Downloading Ensembl Funcgen files to %s ...' % dataDir)
+    funcgenFiles = {}
+    for f, location in iterFuncgenDownloads(organism, dataDir, fileTypes, downloadWorkers):
+      funcgenFiles[f] = location
+      parseDimensionTables(funcgenFiles, tables, schemaBuild, forceCurrentSchema, chunksize,
+          probeSets=not pandasPipeline, arrayNames=arrayNames)
+  else:
+    print('Skipping download of Ensembl Funcgen files ...')
+    funcgenFiles = getFuncgenFilenames(dataDir)
+    parseDimensionTables(funcgenFiles, tables, schemaBuild, forceCurrentSchema, chunksize,
+        probeSets=not pandasPipeline, arrayNames=arrayNames)
+  seqRegionIdMap = tables['seqRegionIdMap']
+  expressionArrayChipIds = tables['expressionArrayChipIds']
+  if arrayNames is not None and arrays != 'curated':
+    missing = arrayNames - set(expressionArrayChipIds.values())
+    if missing:
+      print('Not expression arrays in the funcgen tables: %s' % ', '.join(sorted(missing)), file=sys.stderr)
+  #below takes a little while -> TODO optimise
+  print('Start expression probes time: ' + str(datetime.datetime.now()))
+  if pandasPipeline:
+    expressionProbeFrame = getExpressionProbeDataFrame(funcgenFiles['probe'], funcgenFiles['probe_set'],
+        expressionArrayChipIds)
+  elif join == 'merge':
+    #probes are streamed alongside the probe features when creating the bed file
+    pass
+  elif lookupTable:
+    probeTable = getExpressionProbeTable(funcgenFiles['probe'], funcgenFiles['probe_set'],
+        expressionArrayChipIds, chunksize=chunksize, probeSets=tables['probeSets'])
+  else:
+    expressionProbes = getExpressionProbes(funcgenFiles['probe'], funcgenFiles['probe_set'],
+        expressionArrayChipIds, chunksize=chunksize, probeSets=tables['probeSets'])
+  print('Start create bed time: ' + str(datetime.datetime.now()))
+  if resume and (pandasPipeline or lookupTable or join == 'merge'):
+    print('Only the default hash join without --lookup-table can be resumed, starting over', file=sys.stderr)
+  if join == 'merge' and not pandasPipeline:
+    createBedFileByMergeJoin(funcgenFiles['probe_feature'], seqRegionIdMap, funcgenFiles['probe'],
+        tables['probeSets'], expressionArrayChipIds, output, organism, chunksize, sortMemory, dataDir,
+        sortOutput)
+  elif lookupTable and not pandasPipeline:
+    createBedFileFromTable(funcgenFiles['probe_feature'], seqRegionIdMap, probeTable,
+        output, organism, chunksize, sortOutput, sortMemory)
+  elif not pandasPipeline:
+    createBedFileParallel(funcgenFiles['probe_feature'], seqRegionIdMap, expressionProbes,
+        output, organism, chunksize, workers, sortOutput, sortMemory, resume)
+  else:
+    createBedFileFromDataFrame(funcgenFiles['probe_feature'], seqRegionIdMap, expressionProbeFrame,
+        output, organism, chunksize, sortOutput, sortMemory)
+  if collapse:
+    print('Start collapse probe sets time: ' + str(datetime.datetime.now()))
+    collapseProbeSets(output, output)
+  if bgzip:
+    print('Start bgzip bed time: ' + str(datetime.datetime.now()))
+    bgzftools.compressBedFile(output, output + '.gz')
+  if cleanUp:
+    #tables are only read from the gzipped downloads, so those are all there is to remove
+    for f in fileTypes:
+      if os.path.isfile(funcgenFiles[f]):
+        os.remove(funcgenFiles[f])
+
+#builds the probe bed of one organism of a batch in a worker process, with everything it prints
+# going to logFile.
+#@return organism, output
+def buildBatchProbeBed(organism, dataDir, output, logFile, options):
+  import contextlib
+  with open(logFile, 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+    print('Start get_ensembl_probes %s @ time: %s' % (organism, datetime.datetime.now()), flush=True)
+    try:
+      buildProbeBed(organism, dataDir, output, options)
+    except BaseException:
+      traceback.print_exc()
+      raise
+    print('Done get_ensembl_probes %s @ time: %s' % (organism, datetime.datetime.now()), flush=True)
+  return organism, output
+
+#builds the probe beds of several funcgen organisms at once, batchWorkers organisms at a time.
+#the funcgen tables are downloaded to a shared cache, cacheDir/release-<ensembl release>/<organism>/,
+# so organisms (and later batches) of the same release are only downloaded once with --no-download.
+#each organism's bed goes to batchDir/<organism>/outputName, with its log next to it.
+#@return dict of organism to bed file, for the organisms that were built
+def buildProbeBeds(organisms, cacheDir, batchDir, outputName, options, batchWorkers):
+  print('Start get_ensembl_probes batch @ time: ' + str(datetime.datetime.now()))
+  jobs = {}
+  for organism in organisms:
+    if not options['noDownload']:
+      organism = getAvailableOrganism(organism, cacheDir)
+    release = getSchemaBuildFromOrganism(organism).split('_')[0]
+    dataDir = os.path.join(cacheDir, 'release-%s' % release, organism)
+    outputDir = os.path.join(batchDir, organism)
+    os.makedirs(dataDir, exist_ok=True)
+    os.makedirs(outputDir, exist_ok=True)
+    jobs[organism] = (dataDir, os.path.join(outputDir, outputName),
+        os.path.join(outputDir, 'get_ensembl_probes.log'))
+  outputs = {}
+  failed = []
+  with concurrent.futures.ProcessPoolExecutor(max_workers=batchWorkers) as executor:
+    futures = {executor.submit(buildBatchProbeBed, organism, dataDir, output, logFile, options): organism
+        for organism, (dataDir, output, logFile) in jobs.items()}
+    for future in concurrent.futures.as_completed(futures):
+      organism = futures[future]
+      try:
+        organism, output = future.result()
+        outputs[organism] = output
+        print('Built %s @ time: %s' % (output, datetime.datetime.now()))
+      except (Exception, SystemExit) as e:
+        failed.append(organism)
+        print('Failed to build probes for %s (%s), see %s' % (organism, e, jobs[organism][2]), file=sys.stderr)
+  print('Done get_ensembl_probes batch @ time: ' + str(datetime.datetime.now()))
+  if failed:
+    sys.exit(1)
+  return outputs
+
 def usage(defaults):
   print('Usage: ' + sys.argv[0] + \
       ' -d, --data-dir <CREATED_DIR> -f, --force-current-schema ' + \
       '-c, --chunksize <FILE_LINES_READ_AT_ONCE> ' + \
+      '-s, --sort --sort-memory <SIZE> -z, --bgzip --download-workers <N> --lookup-table --join <hash|merge> --workers <N> ' + \
+      '--arrays <curated|ARRAY,ARRAY,...|ARRAYS_FILE> --collapse-probe-sets --resume ' + \
+      '--organisms <ORGANISM,ORGANISM,...> --cache-dir <DIR> --batch-dir <DIR> --batch-workers <N> ' + \
       '-o, --organism <ORGANISM> <BED_OUTPUT>')
   print('Example: ' + sys.argv[0] + \
       ' --organism homo_sapiens_funcgen_85_38 data/ensembl_probe_features.bed')
   print('Defaults:')
   for key, val in sorted(iter(defaults.items()), key=operator.itemgetter(0)):
     print(str(key) + ' - ' + str(val))
+  print('With --bgzip the sorted output is also written block compressed to <BED_OUTPUT>.gz with a')
+  print('tabix index, for region queries with bgzftools.py (or tabix) and to speed up find_overlap.py')
+  print('With --organisms the organisms are built in a batch: tables are downloaded to')
+  print('<cache-dir>/release-<RELEASE>/<ORGANISM>/ and each bed and log goes to <batch-dir>/<ORGANISM>/')
 
 def __main__():
-  shortOpts = 'hc:d:o:fnp'
+  shortOpts = 'hc:d:o:fnpsz'
   longOpts = ['help', 'chunksize=', 'data-dir=', 'organism=', \
-      'force-current-schema', 'no-download']  #, 'file-types']
+      'force-current-schema', 'no-download', 'sort', 'sort-memory=', 'bgzip', 'download-workers=', 'lookup-table', 'join=', 'workers=', 'arrays=', 'collapse-probe-sets', 'resume',
+      'organisms=', 'cache-dir=', 'batch-dir=', 'batch-workers=']  #, 'file-types']
   defaults = c.GET_ENSEMBL_PROBES_DEFAULTS
   chunksize = defaults['chunksize']
   dataDir = defaults['dataDir']
@@ -494,6 +1098,20 @@ def __main__():
   noDownload = defaults['noDownload']
   pandasPipeline = defaults['pandasPipeline']
   cleanUp = defaults['cleanUp']
+  sortOutput = defaults['sort']
+  sortMemory = defaults['sortMemory']
+  bgzip = defaults['bgzip']
+  downloadWorkers = defaults['downloadWorkers']
+  lookupTable = defaults['lookupTable']
+  join = defaults['join']
+  workers = defaults['workers']
+  arrays = defaults['arrays']
+  collapse = defaults['collapseProbeSets']
+  organisms = defaults['organisms']
+  cacheDir = defaults['cacheDir']
+  batchDir = defaults['batchDir']
+  batchWorkers = defaults['batchWorkers']
+  resume = defaults['resume']
   try:
     opts, args = getopt.getopt(sys.argv[1:], shortOpts, longOpts)
   except getopt.GetoptError as err:
@@ -518,10 +1136,54 @@ def __main__():
       pandasPipeline = not pandasPipeline
     elif opt in ('-l', '--cleanup'):
       cleanUp = True
+    elif opt in ('-s', '--sort'):
+      sortOutput = True
+    elif opt == '--sort-memory':
+      sortMemory = arg
+    elif opt in ('-z', '--bgzip'):
+      #the index needs sorted input
+      bgzip = True
+      sortOutput = True
+    elif opt == '--download-workers':
+      downloadWorkers = int(arg)
+    elif opt == '--lookup-table':
+      lookupTable = True
+    elif opt == '--join':
+      join = arg
+    elif opt == '--workers':
+      workers = int(arg)
+    elif opt == '--arrays':
+      arrays = arg
+    elif opt == '--collapse-probe-sets':
+      #merging needs sorted input
+      collapse = True
+      sortOutput = True
+    elif opt == '--resume':
+      resume = True
+    elif opt == '--organisms':
+      organisms = [o.strip() for o in arg.split(',') if o.strip()]
+    elif opt == '--cache-dir':
+      cacheDir = arg
+    elif opt == '--batch-dir':
+      batchDir = arg
+    elif opt == '--batch-workers':
+      batchWorkers = int(arg)
 #    elif opt in ('--file-types'):
 #      fileTypes = arg
   if len(args) > 0:
     output = args[0]
+  if join not in ('hash', 'merge'):
+    print('Invalid --join %s, expected hash or merge' % join, file=sys.stderr)
+    usage(defaults)
+    sys.exit(2)
+  options = {'chunksize': chunksize, 'forceCurrentSchema': forceCurrentSchema, 'fileTypes': fileTypes,
+      'noDownload': noDownload, 'pandasPipeline': pandasPipeline, 'cleanUp': cleanUp, 'sort': sortOutput,
+      'sortMemory': sortMemory, 'bgzip': bgzip, 'downloadWorkers': downloadWorkers,
+      'lookupTable': lookupTable, 'join': join, 'workers': workers, 'arrays': arrays,
+      'collapseProbeSets': collapse, 'resume': resume}
+  if organisms:
+    buildProbeBeds(organisms, cacheDir, batchDir, os.path.basename(output), options, batchWorkers)
+    return
   #add trailing slash to directory so recognised as such
   if not dataDir.endswith('/'):
     dataDir += '/'
@@ -529,79 +1191,12 @@ def __main__():
   #get available funcgen organisms if we don't already have a file with the available 
   # organisms in it
   if not noDownload:
-    #check if we already have the file
-    funcgenOrgDefaults = c.GET_ENSEMBL_FUNCGEN_ORGANISMS_DEFAULTS
-    if dataDir:
-      availableOrganismsFileName = '%s/availableOrganisms.txt' % dataDir
-    else:
-      availableOrganismsFileName = funcgenOrgDefaults['output']
-    availableOrganismsFileName = os.path.normpath(availableOrganismsFileName)
-    #array of available organisms is a dictionary like: 
-    if os.path.isfile(availableOrganismsFileName):
-      #retrieve from file
-      availableOrganisms = []
-      with open(availableOrganismsFileName, 'r') as orgFile:
-        for line in orgFile:
-          availableOrganisms.append(line.strip())
-    else:
-      #download the available organisms
-      availableOrganismsDict = org.parseFtpIndexForOrganisms(funcgenOrgDefaults['url'], availableOrganismsFileName, None, None, None)
-      #turn dict like: homo_sapiens_funcgen_84_38 -> Homo sapiens v84.38
-      # into array of keys
-      availableOrganisms = list(availableOrganismsDict.keys())
-    #match the default or user-passed organism against the up-to-date one
-    newOrganism = None
-    for availOrg in availableOrganisms:
-      if availOrg.lower().startswith(organism.lower().split('_funcgen')[0]):
-        newOrganism = availOrg
-        break
-    if newOrganism:
-      oldOrganism = organism
-      organism = newOrganism
-      print('Updated Ensembl organism %s to %s' % (oldOrganism, organism))
-    else:
-      print('No matching new Ensembl organism for %s, download from Ensembl may fail' % organism, file=sys.stderr)
-  #get schema build from organism name string
-  print('Getting schema build from organism %s ...' % organism)
-  schemaBuild = getSchemaBuildFromOrganism(organism)
-  #pipeline:
-  #grab funcgen database flat files for ensembl organism.
-  #store file name to location in a map.
-  #keys are fixed: array, array_chip, coord_system, probe, probe_set, probe_feature, seq_region
-  if not noDownload:
-    print('Downloading Ensembl Funcgen files to %s ...' % dataDir)
-    funcgenFiles = getFuncgenFiles(organism, dataDir, fileTypes, cleanUp)
-  else:
-    print('Skipping download of Ensembl Funcgen files ...')
-  #get current coordinate system id corresponding to chromosomes
-  print('Start coord system time: ' + str(datetime.datetime.now()))
-  coordSystemId = getCoordSystemId(funcgenFiles['coord_system'], schemaBuild, forceCurrentSchema)
-  print('Coordinate system id: %s' % coordSystemId)
-  #get all sequence region ids for those chromosomes. note # ids = # chromosomes in the organism.
-  print('Start sequence regions time: ' + str(datetime.datetime.now()))
-  seqRegionIdMap = getSequenceRegionIds(funcgenFiles['seq_region'], coordSystemId, schemaBuild)
-  print('Number of sequence region ids: %s' % len(seqRegionIdMap))
-  #get array and probe data to be able to filter out the non-expression array probe features
-  print('Start expression arrays time: ' + str(datetime.datetime.now()))
-  expressionArrayChipIds = getExpressionArrays(funcgenFiles['array'], funcgenFiles['array_chip'])
-  #below takes a little while -> TODO optimise
-  print('Start expression probes time: ' + str(datetime.datetime.now()))
-  if not pandasPipeline:
-    expressionProbes = getExpressionProbes(funcgenFiles['probe'], funcgenFiles['probe_set'],
-        expressionArrayChipIds, chunksize=chunksize)
-  else:
-    expressionProbeFrame = getExpressionProbeDataFrame(funcgenFiles['probe'], funcgenFiles['probe_set'],
-        expressionArrayChipIds)
-  print('Start create bed time: ' + str(datetime.datetime.now()))
-  if not pandasPipeline:
-    createBedFile(funcgenFiles['probe_feature'], seqRegionIdMap, expressionProbes,
-        output, organism, chunksize)
-  else:
-    createBedFileFromDataFrame(funcgenFiles['probe_feature'], seqRegionIdMap, expressionProbeFrame,
-        output, organism)
+    organism = getAvailableOrganism(organism, dataDir)
+  buildProbeBed(organism, dataDir, output, options)
   print('Done get_ensembl_probes @ time: ' + str(datetime.datetime.now()))
-  print('If you wish to sort the BED file by chromosome and start pos, try running:\n')
-  print('\tsort -k1,1 -k2,2n %s > data/probes.sorted.bed\n' % output)
+  if not sortOutput:
+    print('If you wish to sort the BED file by chromosome and start pos, try running with --sort or:\n')
+    print('\tsort -k1,1 -k2,2n %s > data/probes.sorted.bed\n' % output)
 
 if __name__ == '__main__':
   __main__()
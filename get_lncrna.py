@@ -8,6 +8,7 @@ import shutil
 
 #local
 import downloader
+import sorttools
 import ziptools
 import constants as c
 
@@ -40,15 +41,16 @@ def getNoncode(organism, versionString, output):
   ziptools.gunzip(zippedOutput, output)
 
 def usage(defaults):
-  print('Usage: ' + sys.argv[0] + ' [-l, --lncipedia | -n, --noncode | -c, --custom-bed <BED_INPUT>] (--high-conf) -o, --organism <ORGANISM> <BED_OUTPUT>')
+  print('Usage: ' + sys.argv[0] + ' [-l, --lncipedia | -n, --noncode | -c, --custom-bed <BED_INPUT>] (--high-conf) -o, --organism <ORGANISM> (-s, --sort --sort-memory <SIZE>) <BED_OUTPUT>')
   print('Example: ' + sys.argv[0] + ' --noncode --organism hg38 noncode_lncrnas.bed')
   print('Defaults:')
   for (key, val) in sorted(iter(defaults.items()), key=operator.itemgetter(0)):
     print('%s - %s' % (str(key), str(val)))
 
 def __main__():
-  shortOpts = 'hlnc:o:'
-  longOpts = ['help', 'lncipedia', 'noncode', 'custom-bed=', 'organism=', 'high-conf']
+  shortOpts = 'hlnc:o:s'
+  longOpts = ['help', 'lncipedia', 'noncode', 'custom-bed=', 'organism=', 'high-conf', 'sort',
+      'sort-memory=']
   defaults = c.GET_LNCRNA_DEFAULTS
   mode = defaults['mode']
   organism = defaults['organism']
@@ -56,6 +58,8 @@ def __main__():
   highconf = defaults['highconf']
   lncipediaVersion = defaults['lncipediaVersion']  #lncipedia.org version
   noncodeVersion = defaults['noncodeVersion']  #noncode.org version
+  sortOutput = defaults['sort']
+  sortMemory = defaults['sortMemory']
   bedInput = None
   try:
     opts, args = getopt.getopt(sys.argv[1:], shortOpts, longOpts)
@@ -78,6 +82,10 @@ def __main__():
       organism = arg
     elif opt in ('--high-conf'):
       highconf = True
+    elif opt in ('-s', '--sort'):
+      sortOutput = True
+    elif opt == '--sort-memory':
+      sortMemory = arg
   if len(args) > 0:
     output = args[0]
   print('Called with these args:\nmode=%s\norganism=%s\noutput=%s\nhighconf=%s\nlncipediaVersion=%s\nnoncodeVersion=%s\nbedInput=%s' % \
@@ -88,8 +96,11 @@ def __main__():
     getNoncode(organism, noncodeVersion, output)
   else:
     shutil.copy(bedInput, output)
-  print('If you wish to sort the BED file by chromosome and start pos, try running:\n')
-  print('\tsort -k1,1 -k2,2n %s > data/lncrna.sorted.bed\n' % output)
+  if sortOutput:
+    sorttools.sortBedFile(output, output, sortMemory)
+  else:
+    print('If you wish to sort the BED file by chromosome and start pos, try running with --sort or:\n')
+    print('\tsort -k1,1 -k2,2n %s > data/lncrna.sorted.bed\n' % output)
 
 if __name__ == '__main__':
   __main__()
@@ -233,3 +233,13 @@ def nameToKey(orgName: str) -> str:
   '''
   key = '_'.join(orgName.lower().split(' '))
   return key
+
+
+def getCuratedArrays(organismKey: str) -> set:
+  '''
+    Returns the names of the arrays of an organism that have at least one GPL curated in
+    ORG_TO_ARRAY_TO_GPL, i.e. those whose probes can lead to expression data in GEO.
+    The organism can be like 'homo_sapiens_funcgen_85_38', 'homo_sapiens_funcgen' or 'homo_sapiens'.
+  '''
+  org = organismKey.split('_funcgen')[0]
+  return set(array for (array, gpls) in ORG_TO_ARRAY_TO_GPL.get(org, {}).items() if gpls)
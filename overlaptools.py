@@ -0,0 +1,672 @@
+#!/usr/bin/env python3
+# Native overlap engine for sorted BED files.
+# Reproduces the bedtools intersect -sorted calls used by find_overlap.py without needing bedtools:
+#  -wa -wb (every overlapping A/B pair) and -u (features with any overlap) for both A and B,
+#  all computed in one pass over the two files.
+# It can also read BED-12 A features whole and aggregate their overlap over blocks (exons).
+#
+# Both inputs must be sorted by chromosome (lexicographic, C locale) and then start position,
+#  e.g. by find_overlap.normalizeAndSortBed or sort -k1,1 -k2,2n.
+#
+
+import bisect
+import datetime
+import itertools
+import json
+import operator
+import os
+import sys
+from array import array
+
+
+OPPOSITE_STRANDS = {'+': '-', '-': '+'}
+
+
+def iterBedRecords(lines):
+  '''
+  Parses BED lines into records, skipping blank, comment, track and browser lines.
+
+  Args:
+    lines (iterable): BED lines, e.g. an open file.
+
+  Yields:
+    tuple: (chrom, start, end, strand, line) with integer start/end, strand '.' if the line has no
+      strand column, and the line stripped of its newline.
+  '''
+  for line in lines:
+    line = line.rstrip('\r\n')
+    if not line or line.startswith(('#', 'track', 'browser')):
+      continue
+    cols = line.split('\t', 6)
+    strand = cols[5] if len(cols) > 5 else '.'
+    yield (cols[0], int(cols[1]), int(cols[2]), strand, line)
+
+
+def iterChromGroups(records):
+  '''
+  Groups consecutive records by chromosome.
+
+  Yields:
+    tuple: (chrom, iterator of records on chrom)
+  '''
+  return itertools.groupby(records, key=operator.itemgetter(0))
+
+
+class ChromIndex(object):
+  '''
+  Features on a single chromosome (and strand, in stranded modes) sorted by start, queryable for
+  overlap by binary search. Each feature keeps its position among all the features of its chromosome
+  so that results from several strand indexes can be put back into file order.
+  '''
+  def __init__(self, positionedRecords):
+    self.starts = array('q')
+    self.ends = array('q')
+    self.positions = array('q')
+    self.lines = []
+    self.maxLength = 0
+    for (position, (chrom, start, end, strand, line)) in positionedRecords:
+      self.starts.append(start)
+      self.ends.append(end)
+      self.positions.append(position)
+      self.lines.append(line)
+      if end - start > self.maxLength:
+        self.maxLength = end - start
+    #built on first use by nearest()
+    self.endOrder = None
+    self.sortedEnds = None
+
+  def __len__(self):
+    return len(self.lines)
+
+  def query(self, start, end):
+    '''
+    Returns the indices, in sorted order, of the features overlapping [start, end) by at least 1 bp.
+    Only features starting after start - maxLength can reach start so the scan is bounded both ways.
+    '''
+    lo = bisect.bisect_right(self.starts, start - self.maxLength)
+    hi = bisect.bisect_left(self.starts, end)
+    ends = self.ends
+    return [i for i in range(lo, hi) if ends[i] > start]
+
+  def nearest(self, start, end, maxDistance):
+    '''
+    Finds the closest features not overlapping [start, end), up or downstream, by binary search on
+    the sorted starts (downstream) and sorted ends (upstream). Distance follows bedtools closest -d:
+    book-ended features are 1 bp apart. All features tied at the closest distance are returned.
+
+    Returns:
+      tuple: (distance, sorted list of feature indices), or (None, []) if none within maxDistance.
+    '''
+    if self.endOrder is None:
+      self.endOrder = array('q', sorted(range(len(self.ends)), key=self.ends.__getitem__))
+      self.sortedEnds = array('q', (self.ends[i] for i in self.endOrder))
+    best = None
+    found = []
+    #downstream: first features starting at or after end
+    i = bisect.bisect_left(self.starts, end)
+    if i < len(self.starts):
+      best = self.starts[i] - end + 1
+      j = i
+      while j < len(self.starts) and self.starts[j] == self.starts[i]:
+        found.append(j)
+        j += 1
+    #upstream: last features ending at or before start
+    k = bisect.bisect_right(self.sortedEnds, start) - 1
+    if k >= 0:
+      distance = start - self.sortedEnds[k] + 1
+      if best is None or distance <= best:
+        if best is None or distance < best:
+          found = []
+        best = distance
+        j = k
+        while j >= 0 and self.sortedEnds[j] == self.sortedEnds[k]:
+          found.append(self.endOrder[j])
+          j -= 1
+    if best is None or best > maxDistance:
+      return (None, [])
+    return (best, sorted(found))
+
+
+class OverlapCounts(object):
+  '''
+  Counts of the lines written to the overlap outputs, kept during the intersect pass so the summary
+  doesn't have to read the outputs back (see writeOverlapSummary): per chromosome line counts of
+  outputA (a), outputB (b) and output (pairs), and the probe sets and probes of each array in outputB
+  and nearestOutput. The counts of separate passes, e.g. of the chromosomes of a parallel run, are
+  combined with merge.
+  '''
+  def __init__(self):
+    self.chromosomes = {}
+    #array -> [set of probe set names, # probes]
+    self.arrays = {}
+    self.nearestArrays = {}
+
+  def addLines(self, chrom, key, count):
+    '''
+    Adds count lines on chrom to the outputA (a), outputB (b) or output (pairs) count.
+    '''
+    if count:
+      counts = self.chromosomes.setdefault(chrom, {'a': 0, 'b': 0, 'pairs': 0})
+      counts[key] += count
+
+  def merge(self, other):
+    '''
+    Adds the counts of another OverlapCounts to these.
+    '''
+    for (chrom, counts) in other.chromosomes.items():
+      for (key, count) in counts.items():
+        self.addLines(chrom, key, count)
+    for (arrays, otherArrays) in ((self.arrays, other.arrays), (self.nearestArrays, other.nearestArrays)):
+      for (array, (probeSets, probes)) in otherArrays.items():
+        counts = arrays.setdefault(array, [set(), 0])
+        counts[0].update(probeSets)
+        counts[1] += probes
+    return self
+
+
+def getFeatureName(line):
+  '''
+  Returns the name column of a BED line, or the whole line for BED-3.
+  '''
+  cols = line.split('\t', 4)
+  return cols[3] if len(cols) > 3 else line
+
+
+def getIndexKey(strand, strandMode):
+  '''
+  Returns the index key B features on a strand are stored under (strandMode None: all together).
+  '''
+  return strand if strandMode else None
+
+
+def getQueryKey(strand, strandMode):
+  '''
+  Returns the index key to query for an A feature on a strand: None when unstranded, the same strand,
+  or the opposite strand. Features without a + or - strand get None, which is never an index key in
+  the stranded modes, so they match nothing.
+  '''
+  if strandMode == 'same':
+    return strand if strand in OPPOSITE_STRANDS else None
+  if strandMode == 'opposite':
+    return OPPOSITE_STRANDS.get(strand)
+  return None
+
+
+def buildChromIndexes(records, strandMode=None):
+  '''
+  Indexes the records of one chromosome, one ChromIndex per strand when strandMode is set so that
+  strand matching is part of the lookup rather than a filter on its results.
+
+  Returns:
+    dict: Index key (see getIndexKey) -> ChromIndex.
+  '''
+  byKey = {}
+  for (position, record) in enumerate(records):
+    byKey.setdefault(getIndexKey(record[3], strandMode), []).append((position, record))
+  return {key: ChromIndex(positioned) for (key, positioned) in byKey.items()}
+
+
+def buildIndex(recordsB, strandMode=None):
+  '''
+  Indexes all of sorted records B, so that several inputs can be intersected with B without reading
+  it again (see intersectIndexed). Unlike intersectRecords, memory is proportional to all of B.
+
+  Returns:
+    dict: chrom -> indexes of the chromosome, see buildChromIndexes.
+  '''
+  return {chrom: buildChromIndexes(group, strandMode) for (chrom, group) in iterChromGroups(recordsB)}
+
+
+def intersectRecords(recordsA, recordsB, output=None, outputA=None, outputB=None,
+    nearestOutput=None, counts=None, **options):
+  '''
+  Finds the overlap between sorted records A and B, writing:
+  - output: one line per overlapping pair, A columns then B columns (bedtools intersect -wa -wb).
+    With metrics, three more columns follow: overlap length in bp, fraction of A covered, and
+    fraction of B covered.
+  - outputA: features in A overlapping any feature in B (bedtools intersect -a A -b B -u).
+  - outputB: features in B overlapping any feature in A (bedtools intersect -a B -b A -u).
+  - nearestOutput: for each feature name in A with no overlap at all (over all of its lines, e.g. the
+    exons of a transcript), the closest features in B within maxDistance: A columns, B columns, then
+    the distance. Only the closest line(s) of A are reported.
+
+  B is indexed one chromosome at a time, so memory is bounded by the largest chromosome in B.
+  Any of the outputs may be None to skip it.
+
+  Args:
+    recordsA (iterable): Sorted records of A, see iterBedRecords.
+    recordsB (iterable): Sorted records of B, see iterBedRecords.
+    output, outputA, outputB, nearestOutput: Writable text files or None.
+    counts (OverlapCounts): Added to as the outputs are written, if given.
+    options: See intersectChrom.
+  '''
+  strandMode = options.get('strandMode')
+  groupsB = iterChromGroups(recordsB)
+  chromB, groupB = next(groupsB, (None, None))
+  for chromA, groupA in iterChromGroups(recordsA):
+    while chromB is not None and chromB < chromA:
+      chromB, groupB = next(groupsB, (None, None))
+    if chromB != chromA:
+      continue
+    intersectChrom(groupA, buildChromIndexes(groupB, strandMode), output, outputA, outputB,
+        nearestOutput, counts=counts, **options)
+
+
+def intersectIndexed(recordsA, index, output=None, outputA=None, outputB=None,
+    nearestOutput=None, counts=None, **options):
+  '''
+  Same as intersectRecords, but against B already indexed by buildIndex. options must have the
+  strandMode the index was built with.
+  '''
+  for chromA, groupA in iterChromGroups(recordsA):
+    if chromA in index:
+      intersectChrom(groupA, index[chromA], output, outputA, outputB, nearestOutput, counts=counts,
+          **options)
+
+
+def getBlocks(start, end, line):
+  '''
+  Returns the (start, end) blocks, e.g. exons, of a BED-12 line, or the whole feature for other lines.
+  '''
+  cols = line.split('\t')
+  if len(cols) < 12:
+    return [(start, end)]
+  sizes = cols[10].rstrip(',').split(',')
+  offsets = cols[11].rstrip(',').split(',')
+  return [(start + int(offset), start + int(offset) + int(size))
+      for (offset, size) in zip(offsets[:int(cols[9])], sizes)]
+
+
+def getBed6(line):
+  '''
+  Returns the first 6 columns of a BED line.
+  '''
+  return '\t'.join(line.split('\t', 6)[:6])
+
+
+def getNearestToBlocks(index, blocks, maxDistance):
+  '''
+  Finds the closest features to any of a feature's blocks, see ChromIndex.nearest.
+  '''
+  best = None
+  found = set()
+  for (blockStart, blockEnd) in blocks:
+    (distance, nearest) = index.nearest(blockStart, blockEnd, maxDistance)
+    if distance is None or (best is not None and distance > best):
+      continue
+    if best is None or distance < best:
+      (best, found) = (distance, set())
+    found.update(nearest)
+  return (best, sorted(found))
+
+
+def intersectChrom(recordsA, indexes, output=None, outputA=None, outputB=None,
+    nearestOutput=None, maxDistance=0, minFractionA=0.0, minFractionB=0.0, metrics=False,
+    strandMode=None, blocks=False, counts=None):
+  '''
+  Writes the overlap of the records of A on one chromosome with the indexes of B on that chromosome.
+  See intersectRecords for the outputs. What is written is added to counts, if given.
+
+  Pairs covering less than minFractionA of A or minFractionB of B (bedtools intersect -f and -F) are
+  dropped from output, outputA and outputB. They still count as overlap for nearestOutput.
+
+  With strandMode 'same' or 'opposite' (bedtools intersect -s and -S) features only overlap, or are
+  nearest to, features on the same or opposite strand respectively.
+
+  With blocks, BED-12 features of A are tested block by block (exon by exon) and each A/B pair is
+  written once: A as BED-6, B, then the number of A blocks overlapping B. Metrics and fractions are
+  over all the blocks, with the length of A being the sum of its blocks. Nearest features are measured
+  from the closest block, and A is written as BED-6 there too.
+
+  Args:
+    recordsA (iterable): Sorted records of A on the chromosome, see iterBedRecords.
+    indexes (dict): Indexes of B on the chromosome, see buildChromIndexes.
+    output, outputA, outputB, nearestOutput: Writable text files or None.
+    maxDistance (int): Maximum distance for nearest features.
+    minFractionA (float): Minimum fraction of A an overlap must cover.
+    minFractionB (float): Minimum fraction of B an overlap must cover.
+    metrics (bool): Whether to append the overlap metrics columns to output.
+    strandMode (str): None, 'same' or 'opposite'. Must match the one indexes were built with.
+    blocks (bool): Whether to test BED-12 features of A by block and aggregate by feature.
+    counts (OverlapCounts): Counts of the lines written, added to as they're written.
+  '''
+  measure = metrics or minFractionA > 0 or minFractionB > 0
+  hits = {key: bytearray(len(index)) for (key, index) in indexes.items()}
+  overlappingNames = set()
+  nearestByName = {}
+  chrom = None
+  linesA = 0
+  pairCount = 0
+  for (chrom, start, end, strand, line) in recordsA:
+    key = getQueryKey(strand, strandMode)
+    index = indexes.get(key)
+    if index is None:
+      continue
+    if blocks:
+      featureBlocks = getBlocks(start, end, line)
+      lineA = getBed6(line)
+    else:
+      featureBlocks = [(start, end)]
+      lineA = line
+    #index of each overlapping B feature -> [A blocks overlapping it, bp overlapped]
+    overlapping = {}
+    for (blockStart, blockEnd) in featureBlocks:
+      for i in index.query(blockStart, blockEnd):
+        hit = overlapping.setdefault(i, [0, 0])
+        hit[0] += 1
+        hit[1] += min(blockEnd, index.ends[i]) - max(blockStart, index.starts[i])
+    if not overlapping:
+      if nearestOutput is not None:
+        (distance, found) = getNearestToBlocks(index, featureBlocks, maxDistance)
+        if found:
+          name = getFeatureName(line)
+          (bestDistance, pairs) = nearestByName.get(name, (distance, []))
+          if distance < bestDistance:
+            (bestDistance, pairs) = (distance, [])
+          if distance == bestDistance:
+            pairs.extend(f'{lineA}\t{index.lines[i]}\t{distance}\n' for i in found)
+          nearestByName[name] = (bestDistance, pairs)
+      continue
+    if nearestOutput is not None:
+      overlappingNames.add(getFeatureName(line))
+    lengthA = max(sum(blockEnd - blockStart for (blockStart, blockEnd) in featureBlocks), 1)
+    indexHits = hits[key]
+    pairs = []
+    for i in sorted(overlapping):
+      (blocksHit, overlapLength) = overlapping[i]
+      suffix = f'\t{blocksHit}' if blocks else ''
+      if measure:
+        fractionA = overlapLength / lengthA
+        fractionB = overlapLength / max(index.ends[i] - index.starts[i], 1)
+        if fractionA < minFractionA or fractionB < minFractionB:
+          continue
+        if metrics:
+          suffix += f'\t{overlapLength}\t{fractionA:.4f}\t{fractionB:.4f}'
+      pairs.append(f'{lineA}\t{index.lines[i]}{suffix}\n')
+      indexHits[i] = 1
+    if not pairs:
+      continue
+    if outputA is not None:
+      outputA.write(f'{line}\n')
+      linesA += 1
+    if output is not None:
+      output.writelines(pairs)
+      pairCount += len(pairs)
+  if outputB is not None:
+    #restore file order across the strand indexes
+    hitLines = []
+    for (key, index) in indexes.items():
+      indexHits = hits[key]
+      hitLines.extend((index.positions[i], index.lines[i]) for i in range(len(index)) if indexHits[i])
+    hitLines.sort()
+    outputB.writelines(f'{line}\n' for (position, line) in hitLines)
+    if counts is not None:
+      counts.addLines(chrom, 'b', len(hitLines))
+      addProbeLines(counts.arrays, (line for (position, line) in hitLines), 3)
+  for (name, (distance, pairs)) in nearestByName.items():
+    if name not in overlappingNames:
+      nearestOutput.writelines(pairs)
+      if counts is not None:
+        #B columns follow the 6 columns of A
+        addProbeLines(counts.nearestArrays, pairs, 9)
+  if counts is not None:
+    counts.addLines(chrom, 'a', linesA)
+    counts.addLines(chrom, 'pairs', pairCount)
+
+
+def intersectSortedFiles(inputA, inputB, output=None, outputA=None, outputB=None,
+    nearestOutput=None, **options):
+  '''
+  File based wrapper for intersectRecords. Outputs given as None are skipped, and any other keyword
+  options are passed on to intersectRecords.
+
+  Returns:
+    OverlapCounts: Counts of the lines written, for writeOverlapSummary.
+  '''
+  counts = OverlapCounts()
+  paths = (output, outputA, outputB, nearestOutput)
+  files = [open(path, 'w') if path else None for path in paths]
+  try:
+    with open(inputA, 'r') as a, open(inputB, 'r') as b:
+      intersectRecords(iterBedRecords(a), iterBedRecords(b), *files, counts=counts, **options)
+  finally:
+    for f in files:
+      if f is not None:
+        f.close()
+  return counts
+
+
+def intersectBatch(queries, inputB, **options):
+  '''
+  Intersects several sorted A files with one sorted B file, reading and indexing B only once.
+
+  Args:
+    queries (list): (inputA, output, outputA, outputB, nearestOutput) tuples, with outputs as for
+      intersectSortedFiles.
+    inputB (str): Path to sorted BED file B.
+    options: See intersectChrom.
+
+  Returns:
+    list: OverlapCounts of each query's outputs, in query order.
+  '''
+  print(f'Indexing {inputB} @ {datetime.datetime.now()} ...')
+  with open(inputB, 'r') as b:
+    index = buildIndex(iterBedRecords(b), options.get('strandMode'))
+  queryCounts = []
+  for (inputA, *paths) in queries:
+    print(f'Intersecting {inputA} with indexed {inputB} @ {datetime.datetime.now()} ...')
+    counts = OverlapCounts()
+    files = [open(path, 'w') if path else None for path in paths]
+    try:
+      with open(inputA, 'r') as a:
+        intersectIndexed(iterBedRecords(a), index, *files, counts=counts, **options)
+    finally:
+      for f in files:
+        if f is not None:
+          f.close()
+    queryCounts.append(counts)
+  return queryCounts
+
+
+def getSummaryPath(output):
+  '''
+  Returns the path of the summary sidecar of an overlap output, e.g. data/overlap.summary.json.
+  '''
+  return os.path.splitext(output)[0] + '.summary.json'
+
+
+def getFileFingerprint(path, fileHash=None):
+  '''
+  Returns the absolute path, size and modification time of a file, plus its SHA-256 if given.
+  '''
+  stat = os.stat(path)
+  fingerprint = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+  if fileHash:
+    fingerprint['sha256'] = fileHash
+  return fingerprint
+
+
+def getProbeArray(name):
+  '''
+  Splits a probe feature name, array/probe_set:probe or array/probe, into (array, probe set).
+  '''
+  (array, _, probe) = name.partition('/')
+  return (array, probe.split(':', 1)[0])
+
+
+def addProbeLines(arrays, lines, nameCol=3):
+  '''
+  Adds the probe sets and probes of each array in BED lines of probe features to arrays, a dict of
+  array -> [set of probe set names, # probes].
+  '''
+  for line in lines:
+    cols = line.split('\t', nameCol + 2)
+    if len(cols) <= nameCol + 1:
+      continue
+    (array, probeSet) = getProbeArray(cols[nameCol])
+    counts = arrays.setdefault(array, [set(), 0])
+    counts[0].add(probeSet)
+    counts[1] += 1
+
+
+def getArrayCounts(arrays):
+  '''
+  Returns:
+    dict: array -> {'probeSets': count, 'probes': count}, sorted by array, from the arrays of
+      addProbeLines.
+  '''
+  return {array: {'probeSets': len(arrays[array][0]), 'probes': arrays[array][1]} for array in sorted(arrays)}
+
+
+def countOutputs(output, outputA, outputB, nearestOutput=None):
+  '''
+  Reads the outputs of a pass back to count them, for outputs not written by this module (i.e. by
+  bedtools).
+
+  Returns:
+    OverlapCounts: Counts of the lines in the outputs.
+  '''
+  counts = OverlapCounts()
+  for (key, path) in (('pairs', output), ('a', outputA), ('b', outputB)):
+    if path:
+      with open(path, 'r') as f:
+        for line in f:
+          counts.addLines(line.split('\t', 1)[0], key, 1)
+  if outputB:
+    with open(outputB, 'r') as f:
+      addProbeLines(counts.arrays, f, 3)
+  if nearestOutput and os.path.isfile(nearestOutput):
+    with open(nearestOutput, 'r') as f:
+      #B columns follow the 6 columns of A
+      addProbeLines(counts.nearestArrays, f, 9)
+  return counts
+
+
+def writeOverlapSummary(summaryFile, inputA, inputB, output, outputA, outputB, nearestOutput=None,
+    fileHashes=None, options=None, counts=None):
+  '''
+  Writes a JSON summary of a find_overlap.py run, so that later pipeline steps can answer common
+  questions without rescanning the outputs:
+  - arrays: for each array with a probe in outputB, its number of probe sets and probes.
+  - nearestArrays: the same for the probes in nearestOutput, if any.
+  - chromosomes: per chromosome line counts of outputA (a), outputB (b) and output (pairs).
+  - inputs, outputs: fingerprints of the files, see getFileFingerprint. Readers check the outputs'
+    against the files on disk, see readOverlapSummary.
+
+  Args:
+    summaryFile (str): Path to write the summary to, see getSummaryPath.
+    inputA, inputB (str): Paths to the unsorted inputs.
+    output, outputA, outputB, nearestOutput (str): Paths to the outputs, or None if not written.
+    fileHashes (dict): Path -> SHA-256 of any inputs already hashed.
+    options (dict): The overlap options, recorded as is.
+    counts (OverlapCounts): Counts kept by the native engine as it wrote the outputs. If None, e.g.
+      when bedtools wrote them, the outputs are read back to count them (see countOutputs).
+  '''
+  fileHashes = fileHashes or {}
+  if counts is None:
+    counts = countOutputs(output, outputA, outputB, nearestOutput)
+  chroms = counts.chromosomes
+  summary = {'version': 1, 'inputs': {}, 'outputs': {}}
+  for (key, path) in (('a', inputA), ('b', inputB)):
+    summary['inputs'][key] = getFileFingerprint(path, fileHashes.get(path))
+  outputs = (('output', output), ('outputA', outputA), ('outputB', outputB),
+      ('nearestOutput', nearestOutput))
+  for (key, path) in outputs:
+    if path and os.path.isfile(path):
+      summary['outputs'][key] = getFileFingerprint(path)
+  if outputB:
+    summary['arrays'] = getArrayCounts(counts.arrays)
+  if nearestOutput and os.path.isfile(nearestOutput):
+    summary['nearestArrays'] = getArrayCounts(counts.nearestArrays)
+  summary['chromosomes'] = {chrom: chroms[chrom] for chrom in sorted(chroms)}
+  summary['totals'] = {key: sum(counts[key] for counts in chroms.values()) for key in ('a', 'b', 'pairs')}
+  summary['options'] = options or {}
+  print(f'Writing overlap summary {summaryFile} @ {datetime.datetime.now()} ...')
+  tmp = f'{summaryFile}.tmp'
+  with open(tmp, 'w') as f:
+    json.dump(summary, f, indent=2)
+  os.replace(tmp, summaryFile)
+
+
+def readOverlapSummary(summaryFile, outputKey, path):
+  '''
+  Reads an overlap summary written by writeOverlapSummary, provided it describes the given output
+  file as it is now on disk.
+
+  Args:
+    summaryFile (str): Path to the summary.
+    outputKey (str): Which output path is, e.g. 'outputB'.
+    path (str): Path to the output file.
+
+  Returns:
+    dict: The summary, or None if there is none or it is for another run.
+  '''
+  if not summaryFile or not os.path.isfile(summaryFile) or not os.path.isfile(path):
+    return None
+  try:
+    with open(summaryFile, 'r') as f:
+      summary = json.load(f)
+  except ValueError as err:
+    print(f'Warning: ignoring unreadable overlap summary {summaryFile}: {err}', file=sys.stderr)
+    return None
+  recorded = summary.get('outputs', {}).get(outputKey)
+  if recorded != getFileFingerprint(path):
+    print(f'Ignoring overlap summary {summaryFile}: it does not match {path}')
+    return None
+  return summary
+
+
+def getChromOffsets(bedFile):
+  '''
+  Scans a sorted BED file for the byte range of each chromosome.
+
+  Returns:
+    dict: chrom -> (start byte offset, end byte offset), in file order.
+  '''
+  offsets = {}
+  with open(bedFile, 'rb') as f:
+    chrom = None
+    chromStart = 0
+    pos = 0
+    for line in f:
+      lineChrom = line.split(b'\t', 1)[0].decode()
+      if lineChrom != chrom:
+        if chrom is not None:
+          offsets[chrom] = (chromStart, pos)
+        chrom = lineChrom
+        chromStart = pos
+      pos += len(line)
+    if chrom is not None:
+      offsets[chrom] = (chromStart, pos)
+  return offsets
+
+
+def iterRangeLines(bedFile, start, end):
+  '''
+  Yields the decoded lines of a file between two line-aligned byte offsets.
+  '''
+  with open(bedFile, 'rb') as f:
+    f.seek(start)
+    pos = start
+    while pos < end:
+      line = f.readline()
+      if not line:
+        break
+      pos += len(line)
+      yield line.decode()
+
+
+def __main__(argv):
+  if len(argv) < 6:
+    print(f'Usage: {argv[0]} <SORTED_A> <SORTED_B> <OUTPUT> <OUTPUT_A> <OUTPUT_B>' + \
+        ' [<NEAREST_OUTPUT> <MAX_DISTANCE> [same|opposite]]')
+    sys.exit(2)
+  if len(argv) > 7:
+    intersectSortedFiles(*argv[1:7], maxDistance=int(argv[7]),
+        strandMode=argv[8] if len(argv) > 8 else None)
+  else:
+    intersectSortedFiles(*argv[1:6])
+
+
+if __name__ == '__main__':
+  __main__(sys.argv)
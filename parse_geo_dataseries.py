@@ -10,11 +10,14 @@
 # -BED-like file with mapping of overlap from lncRNA to probe(s)
 # -funcgen organism - for mapping probe platform to GPL id in results
 # -original lncRNA source file - for finding difference of lncRNAs w/ and w/o overlap
+# -(optional) nearest file from find_overlap.py --nearest-distance - lncRNA -> nearby probe(s)
+#  with distance, for lncRNAs without overlap
 #
 # Output: 
 # -lncRNAs with probe expression
 # -lncRNAs with probe overlap but no relevant expression data
 # -lncRNAs with no overlap with Ensembl funcgen probes
+# -(optional) lncRNAs with expression at nearby, non-overlapping probes
 #
 # Algorithm for finding expressed probes:
 #
@@ -62,6 +65,7 @@ import beans
 import constants as c
 import downloader
 import find_geo_platforms as plat
+import overlaptools
 
 
 #one file per line
@@ -73,7 +77,8 @@ def parseFileNames(completedFilesFile):
   return fileNames
 
 
-def parseData(dataDir, outDir, overlapFile, lncrnaFile, organism, completedFilesFile, reverseOverlapFile=False, force=False):
+def parseData(dataDir, outDir, overlapFile, lncrnaFile, organism, completedFilesFile, reverseOverlapFile=False, force=False,
+    nearestFile=None):
   print('Parsing data started @ %s...' % str(datetime.datetime.now()))
   #read in overlap file and make map of lncrna -> probe
   print('Reading in lncrna/probe overlap file %s ...' % overlapFile)
@@ -81,6 +86,16 @@ def parseData(dataDir, outDir, overlapFile, lncrnaFile, organism, completedFiles
   if not overlapMap:
     print('Error: could not parse overlap file %s' % overlapFile) 
     return
+  #optionally read in nearest file and make map of non-overlapping lncrna -> nearby probe
+  nearestMap = None
+  if nearestFile:
+    print('Reading in lncrna/nearby probe file %s ...' % nearestFile)
+    nearestMap = parseOverlapFile(nearestFile, reverse=reverseOverlapFile, nearest=True)
+  #series on platforms without any overlapping (or nearby) probe can be skipped unread
+  relevantGpls = None
+  if not reverseOverlapFile:
+    relevantGpls = getRelevantGplsFromSummary(overlaptools.getSummaryPath(overlapFile), overlapFile,
+        organism, nearestFile)
   print(f'Reading in data series matrix files @ {dataDir if dataDir.endswith("/") else dataDir + "/"}GSE*_series_matrix.txt.gz ...')
   #make sure data dir exists
   if not os.path.exists(dataDir):
@@ -92,6 +107,9 @@ def parseData(dataDir, outDir, overlapFile, lncrnaFile, organism, completedFiles
   #create sub dir for output of expressed lncrnas files for each GEO series
   expressedLncrnasDir = '%s/expressed_series' % outDir
   downloader.createPathToFile(expressedLncrnasDir + '/')
+  nearbyExpressedLncrnasDir = '%s/expressed_series_nearby' % outDir
+  if nearestMap is not None:
+    downloader.createPathToFile(nearbyExpressedLncrnasDir + '/')
   #read in zipped series data matrices one file at a time
   matrixFileNames = [os.path.normpath(f'{dataDir}/{f}') for f in os.listdir(dataDir) if (
                       #only files
@@ -126,12 +144,16 @@ def parseData(dataDir, outDir, overlapFile, lncrnaFile, organism, completedFiles
       try:
         #create map of GPL -> probeSet -> map (GSE, max probe val among samples)
         with gzip.open(fileName, 'rt') as matrixFile:
-          expressionMap = parseSeriesDataMatrix(matrixFile)
+          expressionMap = parseSeriesDataMatrix(matrixFile, relevantGpls)
         #write lncrna expression to file
         lncrnaExpressionMap = getLncrnaExpressionMap(overlapMap, expressionMap, organism)
         seriesExpressedLncrnasFile = '%s/%s.expressed.lncrnas.txt' % ( \
             expressedLncrnasDir, os.path.basename(fileName))
         writeExpressedLncrnas(lncrnaExpressionMap, seriesExpressedLncrnasFile)
+        if nearestMap is not None:
+          nearbyExpressionMap = getLncrnaExpressionMap(nearestMap, expressionMap, organism)
+          writeExpressedLncrnas(nearbyExpressionMap, '%s/%s.expressed.lncrnas.txt' % ( \
+              nearbyExpressedLncrnasDir, os.path.basename(fileName)))
       except Exception as err:
         print(err, file=sys.stderr)
         print('Could not parse series matrix data file: %s' % fileName, file=sys.stderr)
@@ -142,6 +164,10 @@ def parseData(dataDir, outDir, overlapFile, lncrnaFile, organism, completedFiles
   expressedLncrnasFile = os.path.normpath(f'{outDir}/expressed.lncrnas.txt')
   print('> Expressed lncRNAs file will be written to: %s' % expressedLncrnasFile)
   expressedLncrnas = mergeExpressedLncrnaFiles(expressedLncrnasDir, expressedLncrnasFile)
+  if nearestMap is not None:
+    nearbyExpressedLncrnasFile = os.path.normpath(f'{outDir}/nearby.expressed.lncrnas.txt')
+    print('> Nearby probe expressed lncRNAs file will be written to: %s' % nearbyExpressedLncrnasFile)
+    mergeExpressedLncrnaFiles(nearbyExpressedLncrnasDir, nearbyExpressedLncrnasFile)
   #create output file of lncrnas with overlap but missing expression data
   # (i.e. not in expressedLncrnas list but in overlapMap)
   try:
@@ -257,6 +283,9 @@ def writeExpressedLncrnas(lncrnaExpressionMap, expressedLncrnasFile):
   Probe set expression columns like:
   array/probe_set[GSE1:maxval,GSE2:maxval,...] array2/probe_set2[GSE1:maxval,GSE3:maxval,...]
 
+  Probe sets matched by distance rather than overlap (see find_overlap.py --nearest-distance) are
+  written as array/probe_set@<distance>bp[...].
+
   For example:
   chr1	11234	12344	NONHSAG000011.1 0 + HG-U133A/210206_s_at[GSE1:56.8,GSE1234:12.34,GSE56:78.0] HG-U133A/210208_at[GSE1:17.8,GSE1234:12.0,GSE56:100.0] 
   '''
@@ -270,6 +299,9 @@ def writeExpressedLncrnas(lncrnaExpressionMap, expressedLncrnasFile):
             probeSetName = p.probe.probeSetName
             array = p.probe.arrayName
             arrayPlusProbeSet = f'{array}/{probeSetName}'
+            #nearby (non-overlapping) probe sets are suffixed with their distance from the lncRNA
+            if p.probeChromFeat.distance is not None:
+              arrayPlusProbeSet += f'@{p.probeChromFeat.distance}bp'
             gse = p.gse
             if not array or not probeSetName or not gse:
               continue
@@ -378,9 +410,34 @@ def mergeExpressedLncrnaFiles(dataDir: str, outputFile: str) -> list[str]:
   return list(lncrnaExpressionMap.keys())
 
 
-def parseSeriesDataMatrix(matrixFile):
+def getRelevantGplsFromSummary(summaryFile, overlapFile, organism, nearestFile=None):
+  '''
+  Gets the GEO platforms of the arrays with probes in an overlap file (and nearest file) from the
+  find_overlap.py summary sidecar, without reading the overlap file.
+
+  Returns:
+    set: Upper case GPL ids, or None if the summary is missing or not for these files.
+  '''
+  summary = overlaptools.readOverlapSummary(summaryFile, 'output', overlapFile)
+  if summary is None or 'arrays' not in summary:
+    return None
+  arrays = set(summary['arrays'])
+  if nearestFile:
+    if overlaptools.readOverlapSummary(summaryFile, 'nearestOutput', nearestFile) is None:
+      return None
+    arrays.update(summary.get('nearestArrays', {}))
+  gpls = set()
+  for array in arrays:
+    gpls.update(gpl.upper() for gpl in plat.getGplsFromEnsemblArrayName(organism, array))
+  print(f'Only parsing series on the {len(gpls)} GEO platforms in overlap summary {summaryFile}')
+  return gpls
+
+
+def parseSeriesDataMatrix(matrixFile, gpls=None):
   # Map of GPL -> probe set (upper case) -> map(GSE, probe max value).
   # Series matrix table contains probe set to sample values.
+  # If a set of (upper case) GPLs is given, series on other platforms are skipped as soon as
+  # their platform is read, returning an empty map.
   expressionMap = {}
   readTableHeader = False
   readTableRow = False
@@ -395,6 +452,9 @@ def parseSeriesDataMatrix(matrixFile):
     if line.lower().startswith('!series_platform_id'):
       gpl = line.replace('"', '').split('\t')[1].strip().upper()
       print(' > Got %s' % gpl)
+      if gpls is not None and gpl not in gpls:
+        print(' > Skipping %s, no overlapping probes on platform %s' % (gse, gpl))
+        return {}
     if line.lower().startswith('!series_matrix_table_end'):
       readTableRow = False
       continue
@@ -445,11 +505,14 @@ def parseSeriesDataMatrix(matrixFile):
   return expressionMap
 
 
-def parseOverlapFile(overlapFile, reverse=False):
+def parseOverlapFile(overlapFile, reverse=False, nearest=False):
   '''
   Generates a map of key feature name to array of [ key feature, mapped feature 1, mapped feature 2, ...]
 
   i.e. lncRNA name -> [ lncRNA chromosome feature, probe 1 chromosome feature, probe 2 chromosome feature, ...]
+
+  With nearest=True the file is a find_overlap.py nearest file, where the column after the two BED-6
+  features is the distance between them. The distance is kept on the mapped features.
   '''
   print('Parsing overlap file %s @ %s ...' % (overlapFile, str(datetime.datetime.now())))
   overlapMap = {}
@@ -457,9 +520,10 @@ def parseOverlapFile(overlapFile, reverse=False):
     for line in f:
       cols = line.strip().split('\t')
       aCols = cols[:6]
-      bCols = cols[6:]
-      aFeat = getChromFeature(aCols)
-      bFeat = getChromFeature(bCols)
+      bCols = cols[6:12]
+      distance = int(cols[12]) if nearest and len(cols) > 12 else None
+      aFeat = getChromFeature(aCols, distance)
+      bFeat = getChromFeature(bCols, distance)
       if reverse:
         keyfeat = bFeat
         mappedfeat = aFeat
@@ -484,16 +548,16 @@ def parseOverlapFile(overlapFile, reverse=False):
   return overlapMap
 
 
-def getChromFeature(bed6Cols: list[str]) -> beans.ChromFeature:
+def getChromFeature(bed6Cols: list[str], distance: int = None) -> beans.ChromFeature:
   '''
-  Given BED-6 format columns return chromosome feature
+  Given BED-6 format columns (and optionally distance to a matched feature) return chromosome feature
   '''
   chrom = bed6Cols[c.BED_DEFAULTS['chromCol']]
   start = bed6Cols[c.BED_DEFAULTS['startCol']]
   stop = bed6Cols[c.BED_DEFAULTS['stopCol']]
   name = bed6Cols[c.BED_DEFAULTS['nameCol']]
   strand = bed6Cols[c.BED_DEFAULTS['strandCol']]
-  feat = beans.ChromFeature(chrom, start, stop, strand, name)
+  feat = beans.ChromFeature(chrom, start, stop, strand, name, distance)
   return feat
 
 
@@ -533,7 +597,8 @@ def getNonOverlappingLncnras(lncrnaList, overlapMap):
 
 def usage(defaults):
   print('Usage: ' + sys.argv[0] + \
-      ' -d, --data-dir <DIRECTORY> -o, --out-dir <DIRECTORY> -f, --overlap-file <FILE>')
+      ' -d, --data-dir <DIRECTORY> -o, --out-dir <DIRECTORY> -f, --overlap-file <FILE>' + \
+      ' -n, --nearest-file <FILE>')
   print('Example: ' + sys.argv[0] + ' -d data/matrices -o data/results -f data/overlap.bed')
   print('Defaults:')
   for key, val in sorted(iter(defaults.items()), key=operator.itemgetter(0)):
@@ -541,8 +606,9 @@ def usage(defaults):
 
 
 def __main__():
-  shortOpts = 'hvf:d:o:l:r:c:F'
-  longOpts = ['help', 'overlap-file=', 'reverse-overlap', 'data-dir=', 'out-dir=', 'lncrna-file=', 'organism=', 'completed-files-file=', 'force']
+  shortOpts = 'hvf:d:o:l:r:c:Fn:'
+  longOpts = ['help', 'overlap-file=', 'reverse-overlap', 'data-dir=', 'out-dir=', 'lncrna-file=', 'organism=', 'completed-files-file=', 'force',
+      'nearest-file=']
   defaults = c.PARSE_GEO_DATASERIES_DEFAULTS
   overlapFile = defaults['overlapFile']
   reverseOverlapFile = defaults['reverseOverlapFile']
@@ -552,6 +618,7 @@ def __main__():
   organism = defaults['organism']
   completedFilesFile = defaults['completedFilesFile']
   force = defaults['force']
+  nearestFile = defaults['nearestFile']
   try:
     opts, args = getopt.getopt(sys.argv[1:], shortOpts, longOpts)
   except getopt.GetoptError as err:
@@ -578,7 +645,10 @@ def __main__():
       completedFilesFile = arg
     elif opt in ('-F', '--force'): # Force re-parsing completed files
       force = True
-  parseData(dataDir, outDir, overlapFile, lncrnaFile, organism, completedFilesFile, reverseOverlapFile, force)
+    elif opt in ('-n', '--nearest-file'):
+      nearestFile = arg
+  parseData(dataDir, outDir, overlapFile, lncrnaFile, organism, completedFilesFile, reverseOverlapFile, force,
+      nearestFile)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Compact lookup table of expression probes keyed by integer probe id, to join probe features against
+#  instead of a dict of millions of beans.Probe.
+#
+# Probe ids are held sorted in an int64 NumPy array, with parallel int32 indices into tables of the
+#  distinct probe set, probe and array names. Batches of probe ids are looked up at once with
+#  searchsorted.
+#
+
+import sys
+from array import array
+
+
+#index of the empty probe set name, for probes not in a probe set
+NO_PROBE_SET = 0
+
+
+#returns the index of value in names, adding it to names (and the interned map of name to index)
+# if it's not there yet
+def intern(interned, names, value):
+  i = interned.get(value)
+  if i is None:
+    i = interned[value] = len(names)
+    names.append(value)
+  return i
+
+
+class ProbeTable(object):
+  '''
+  Expression probes sorted by integer probe id, each with indices into the probe set, probe and array
+  name tables. Built from an iterable of (probeId, probeSetName, probeName, arrayName) with the probe
+  set name None or '' for probes not in a set. As with a dict, a later probe with the same id replaces
+  an earlier one.
+  '''
+  def __init__(self, probes):
+    import numpy as np
+    self.probeSetNames = ['']
+    self.names = []
+    self.arrayNames = []
+    internedProbeSets = {'': NO_PROBE_SET}
+    internedNames = {}
+    internedArrays = {}
+    ids = array('q')
+    probeSetIndices = array('i')
+    nameIndices = array('i')
+    arrayIndices = array('i')
+    for (probeId, probeSetName, probeName, arrayName) in probes:
+      ids.append(int(probeId))
+      probeSetIndices.append(intern(internedProbeSets, self.probeSetNames, probeSetName or ''))
+      nameIndices.append(intern(internedNames, self.names, probeName))
+      arrayIndices.append(intern(internedArrays, self.arrayNames, arrayName))
+    ids = np.frombuffer(ids, dtype=np.int64) if ids else np.zeros(0, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    ids = ids[order]
+    #keep the last of each run of equal ids
+    last = np.append(ids[1:] != ids[:-1], True) if len(ids) else np.zeros(0, dtype=bool)
+    self.ids = ids[last]
+    self.probeSetIndices, self.nameIndices, self.arrayIndices = (
+        np.asarray(indices, dtype=np.int32)[order][last]
+        for indices in (probeSetIndices, nameIndices, arrayIndices))
+
+  def __len__(self):
+    return len(self.ids)
+
+  def lookup(self, probeIds):
+    '''
+    Looks up a batch of integer probe ids.
+
+    Returns:
+      numpy.ndarray: The table index of each probe id, or -1 where the probe isn't in the table.
+    '''
+    import numpy as np
+    probeIds = np.asarray(probeIds, dtype=np.int64)
+    if not len(self.ids):
+      return np.full(len(probeIds), -1, dtype=np.int64)
+    indices = np.searchsorted(self.ids, probeIds)
+    indices[indices == len(self.ids)] = 0
+    return np.where(self.ids[indices] == probeIds, indices, -1)
+
+  def getProbeDesc(self, i):
+    '''
+    Returns the BED name of the probe at table index i: array/probe_set:probe for probes with a probe
+    set name, else array/probe.
+    '''
+    arrayName = self.arrayNames[self.arrayIndices[i]]
+    probeName = self.names[self.nameIndices[i]]
+    probeSetIndex = self.probeSetIndices[i]
+    if probeSetIndex == NO_PROBE_SET:
+      return '%s/%s' % (arrayName, probeName)
+    return '%s/%s:%s' % (arrayName, self.probeSetNames[probeSetIndex], probeName)
+
+
+def __main__(argv):
+  table = ProbeTable([(3, 'ps1', 'p3', 'HG-U133A'), (1, None, 'p1', 'HG-U133A'), (2, 'ps1', 'p2', 'HuEx')])
+  for i in table.lookup([1, 2, 3, 4]):
+    print(table.getProbeDesc(i) if i >= 0 else None)
+
+if __name__ == '__main__':
+  __main__(sys.argv)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# External merge sort for BED files, for when GNU sort isn't available (e.g. the PyInstaller GUI
+#  builds) or its memory use needs to be bounded from our side.
+#
+# Produces the same order as: LC_ALL=C sort -k1,1 -k2,2n
+#  i.e. chromosome lexicographically, then start numerically, then the whole line as a tie-break.
+#
+
+import datetime
+import heapq
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+#local
+import downloader
+
+
+#rough per-line bookkeeping overhead of a (chrom, start, line) tuple held in memory, in bytes
+RECORD_OVERHEAD = 160
+#number of records pickled together in a sorted run file
+RUN_BLOCK_SIZE = 10000
+HEADER_PREFIXES = ('#', 'track', 'browser')
+#first line of BED files written already sorted (by BucketedBedWriter) in the same order as
+# sortBedLines, i.e. LC_ALL=C sort -k1,1 -k2,2n, so later steps can skip sorting them again
+SORTED_MARKER = '#sorted=-k1,1-k2,2n\n'
+
+
+#parses a memory size like 512M, 2G, or a plain number of bytes
+def parseMemory(size):
+  if isinstance(size, int):
+    return size
+  units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+  size = str(size).strip().upper().rstrip('B')
+  if size and size[-1] in units:
+    return int(float(size[:-1]) * units[size[-1]])
+  return int(size)
+
+#writes a sorted run of records to a temporary file in pickled blocks. the start key is stored
+# with each line so it is only ever parsed once.
+def writeRun(records, tmpDir):
+  fd, path = tempfile.mkstemp(prefix='sort.run.', suffix='.pkl', dir=tmpDir)
+  with os.fdopen(fd, 'wb') as run:
+    for i in range(0, len(records), RUN_BLOCK_SIZE):
+      pickle.dump(records[i:i + RUN_BLOCK_SIZE], run, protocol=pickle.HIGHEST_PROTOCOL)
+  return path
+
+#streams the records of a sorted run file back in order
+def readRun(path):
+  with open(path, 'rb') as run:
+    while True:
+      try:
+        block = pickle.load(run)
+      except EOFError:
+        break
+      yield from block
+
+#sort key of a BED line: chromosome, then start position
+def getBedKey(line):
+  cols = line.split('\t', 2)
+  return (cols[0], int(cols[1]))
+
+#returns a sort key function for tab separated lines on the integer in column col (0-based)
+def getIntColumnKey(col):
+  def getKey(line):
+    return (int(line.split('\t', col + 1)[col]),)
+  return getKey
+
+#sorts lines from an iterable into the output file by getKey(line), a tuple, with the whole line as
+# a tie-break (or, if stable, the input order), using sorted runs of at most memory bytes and a heap based k-way merge. lines
+# starting with one of headerPrefixes (and blank lines) are kept at the top in their original order.
+# the input is fully consumed before the output is opened, so sorting a file in place is safe.
+def sortLines(lines, output, getKey, memory='1G', tmpDir=None, headerPrefixes=HEADER_PREFIXES,
+    stable=False):
+  memory = parseMemory(memory)
+  if not tmpDir:
+    tmpDir = os.path.dirname(os.path.abspath(output))
+  headers = []
+  records = []
+  runPaths = []
+  used = 0
+  try:
+    for (i, line) in enumerate(lines):
+      if not line.endswith('\n'):
+        line += '\n'
+      if not line.strip() or (headerPrefixes and line.startswith(headerPrefixes)):
+        headers.append(line)
+        continue
+      records.append(getKey(line) + ((i, line) if stable else (line,)))
+      used += len(line) + RECORD_OVERHEAD
+      if used >= memory:
+        records.sort()
+        runPaths.append(writeRun(records, tmpDir))
+        records = []
+        used = 0
+    records.sort()
+    if runPaths:
+      if records:
+        runPaths.append(writeRun(records, tmpDir))
+        records = []
+      print(f'sort - merging {len(runPaths)} sorted runs @ {datetime.datetime.now()} ...')
+      merged = heapq.merge(*[readRun(path) for path in runPaths])
+    else:
+      merged = iter(records)
+    downloader.createPathToFile(output)
+    with open(output, 'w') as out:
+      out.writelines(headers)
+      for record in merged:
+        out.write(record[-1])
+  finally:
+    for path in runPaths:
+      downloader.remove(path)
+
+#sorts BED lines from an iterable into the output file by chromosome and start (see sortLines).
+# header lines (track, browser, #) are kept at the top in their original order.
+def sortBedLines(lines, output, memory='1G', tmpDir=None):
+  sortLines(lines, output, getBedKey, memory, tmpDir)
+
+#checks whether the lines are in order of getKey(line), ignoring ties, without holding them
+def isSortedBy(lines, getKey):
+  previous = None
+  for line in lines:
+    key = getKey(line)
+    if previous is not None and key < previous:
+      return False
+    previous = key
+  return True
+
+#checks for the SORTED_MARKER first line of a BED file
+def isMarkedSorted(bedFile):
+  with open(bedFile, 'r') as f:
+    return f.readline() == SORTED_MARKER
+
+
+class BucketedBedWriter(object):
+  '''
+  File-like writer of BED lines to output in sorted order (as sortBedLines), marked with a
+  SORTED_MARKER first line. Lines are spread over a temporary bucket file per chromosome as they're
+  written. On close each bucket is sorted by start, in memory or with sortLines' spilled runs if it
+  doesn't fit, and the buckets are concatenated in chromosome order. Header lines are kept at the top
+  in their original order.
+  '''
+  def __init__(self, output, memory='1G', tmpDir=None):
+    self.output = output
+    self.memory = parseMemory(memory)
+    self.tmpDir = tempfile.mkdtemp(prefix='sort.buckets.',
+        dir=tmpDir or os.path.dirname(os.path.abspath(output)))
+    #chromosome -> [path, open file, # lines]
+    self.buckets = {}
+    self.headers = []
+    self.pending = ''
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    if excType is None:
+      self.close()
+    else:
+      self.discard()
+
+  def write(self, data):
+    #data may hold several lines, or end part way through one
+    lines = (self.pending + data).split('\n')
+    self.pending = lines.pop()
+    for line in lines:
+      self.writeLine(line + '\n')
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def writeLine(self, line):
+    if not line.strip() or line.startswith(HEADER_PREFIXES):
+      self.headers.append(line)
+      return
+    chrom = line.split('\t', 1)[0]
+    bucket = self.buckets.get(chrom)
+    if bucket is None:
+      path = os.path.join(self.tmpDir, '%s.bed' % len(self.buckets))
+      bucket = self.buckets[chrom] = [path, open(path, 'w'), 0]
+    bucket[1].write(line)
+    bucket[2] += 1
+
+  def close(self):
+    if self.pending:
+      self.write('\n')
+    print(f'sort - sorting {len(self.buckets)} chromosome buckets to {self.output} @ {datetime.datetime.now()} ...')
+    try:
+      for (path, bucket, numLines) in self.buckets.values():
+        bucket.close()
+      downloader.createPathToFile(self.output)
+      with open(self.output, 'w') as out:
+        out.write(SORTED_MARKER)
+        out.writelines(self.headers)
+        for chrom in sorted(self.buckets):
+          (path, bucket, numLines) = self.buckets[chrom]
+          if os.path.getsize(path) + numLines * RECORD_OVERHEAD < self.memory:
+            with open(path, 'r') as f:
+              records = [getBedKey(line) + (line,) for line in f]
+            records.sort()
+            out.writelines(record[-1] for record in records)
+            records = None
+          else:
+            sortedPath = path + '.sorted'
+            with open(path, 'r') as f:
+              sortLines(f, sortedPath, getBedKey, self.memory, self.tmpDir)
+            with open(sortedPath, 'r') as f:
+              shutil.copyfileobj(f, out)
+    finally:
+      self.discard()
+
+  def discard(self):
+    for (path, bucket, numLines) in self.buckets.values():
+      bucket.close()
+    self.buckets = {}
+    shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+#sorts a BED file. output may be the same path as the input.
+def sortBedFile(bedFile, output, memory='1G', tmpDir=None):
+  print(f'sort - sorting {bedFile} to {output} @ {datetime.datetime.now()} ...')
+  if os.path.abspath(bedFile) == os.path.abspath(output):
+    #read through a copy so the original stays intact should the sort fail part way
+    fd, copy = tempfile.mkstemp(prefix='sort.input.', dir=tmpDir or os.path.dirname(os.path.abspath(output)))
+    os.close(fd)
+    shutil.move(bedFile, copy)
+    try:
+      with open(copy, 'r') as f:
+        sortBedLines(f, output, memory, tmpDir)
+    except BaseException:
+      shutil.move(copy, bedFile)
+      raise
+    downloader.remove(copy)
+  else:
+    with open(bedFile, 'r') as f:
+      sortBedLines(f, output, memory, tmpDir)
+  print(f'sort - done @ {datetime.datetime.now()}')
+
+def __main__(argv):
+  if len(argv) < 3:
+    print(f'Usage: {argv[0]} <BED_INPUT> <BED_OUTPUT> [MEMORY, e.g. 512M]')
+    sys.exit(2)
+  sortBedFile(argv[1], argv[2], argv[3] if len(argv) > 3 else '1G')
+
+if __name__ == '__main__':
+  __main__(sys.argv)
@@ -55,3 +55,16 @@ def unzipAll(sourceFilename, destDir):
 				path = os.path.join(path, word)
 			zipped.extract(member, path)
 
+
+#open a text file for reading, decompressing on the fly if it's gzipped (by .gz extension).
+# lets tables be streamed straight from the downloaded archive without a gunzip to disk.
+def openText(filename):
+	if filename.endswith('.gz'):
+		return gzip.open(filename, 'rt')
+	return open(filename, 'r')
+
+#binary counterpart of openText, for callers tracking byte offsets into the (uncompressed) file.
+def openBinary(filename):
+	if filename.endswith('.gz'):
+		return gzip.open(filename, 'rb')
+	return open(filename, 'rb')